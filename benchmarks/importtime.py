@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Startup benchmark
+
+    Measures the import time of the command line entry point with
+    'python -X importtime' and the duration of 'dmarchiver --help', and
+    checks that the heavy dependencies (lxml, requests) are not imported
+    before a command needs them.
+
+    Usage:
+    # python benchmarks/importtime.py [-h] [-n REPEAT] [-t TOP] [--max-ms MAX_MS]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Modules which must not be loaded by 'import dmarchiver.cmdline'
+HEAVY_MODULES = ['lxml', 'requests', 'numpy', 'dmarchiver.core']
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _environment():
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [_ROOT] + [path for path in [environment.get('PYTHONPATH')] if path])
+    return environment
+
+
+def measure_imports(statement):
+    """Return the cumulative import time (in us) of each module imported"""
+
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stderr=subprocess.PIPE, universal_newlines=True, env=_environment(), check=True)
+    imports = {}
+    for line in process.stderr.splitlines():
+        result = _IMPORTTIME_RE.match(line)
+        if result is not None:
+            imports[result.group(4)] = int(result.group(2))
+    return imports
+
+
+def measure_command(arguments, repeat):
+    """Return the best wall-clock duration (in ms) of a command"""
+
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'dmarchiver.cmdline'] + arguments,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       env=_environment(), check=True)
+        durations.append((time.perf_counter() - start_time) * 1000)
+    return min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of dmarchiver.')
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Number of runs of each command")
+    parser.add_argument("-t", "--top", type=int, default=10, help="Number of slowest imports to print")
+    parser.add_argument("--max-ms", type=float, help="Fail if the import of the entry point is slower (ms)")
+    args = parser.parse_args()
+
+    # The modules loaded by the interpreter itself (site...) are ignored
+    startup_modules = measure_imports('pass')
+    imports = {module: duration for module, duration in
+               measure_imports('import dmarchiver.cmdline').items()
+               if module not in startup_modules}
+    total = imports.get('dmarchiver.cmdline', 0) / 1000
+    print('import dmarchiver.cmdline: {0:.1f} ms'.format(total))
+    print('Slowest imports (cumulative):')
+    for module, duration in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print('  {0:8.1f} ms  {1}'.format(duration / 1000, module))
+
+    print('dmarchiver --help: {0:.1f} ms (best of {1})'.format(
+        measure_command(['--help'], args.repeat), args.repeat))
+    print('dmarchiver verify --help: {0:.1f} ms (best of {1})'.format(
+        measure_command(['verify', '--help'], args.repeat), args.repeat))
+
+    failed = False
+    heavy_modules = [module for module in imports
+                     if any(module == name or module.startswith(name + '.') for name in HEAVY_MODULES)]
+    if len(heavy_modules) > 0:
+        print('Error: heavy modules imported at startup: {0}'.format(', '.join(sorted(heavy_modules))))
+        failed = True
+    if args.max_ms is not None and total > args.max_ms:
+        print('Error: the import takes more than {0} ms'.format(args.max_ms))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
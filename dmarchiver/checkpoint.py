@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Checkpoint
+
+    Keeps the pages of a running crawl on disk, with the cursor of the
+    next page to retrieve, so that an interrupted crawl can continue its
+    backward pagination instead of starting over. The checkpoint is a
+    JSON lines file: a header with the conversation ID and the latest
+    tweet ID of the previous crawl, then one line per processed page.
+"""
+
+import collections
+import json
+import os
+
+__all__ = ['Checkpoint']
+
+CheckpointState = collections.namedtuple(
+    'CheckpointState', ['max_id', 'cursor', 'done', 'records'])
+
+
+class Checkpoint(object):
+    """This class is a representation of the checkpoint file of a crawl"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._valid_length = 0
+
+    def load(self):
+        """Return the state saved in the checkpoint, or None"""
+
+        try:
+            with open(self.filename, 'rb') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return None
+
+        try:
+            header = json.loads(lines[0].decode('utf-8'))
+        except (IndexError, ValueError):
+            return None
+
+        self._valid_length = len(lines[0])
+        cursor = None
+        done = False
+        records = []
+        for line in lines[1:]:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError
+                page = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # The last page was not completely written
+                break
+            self._valid_length += len(line)
+            cursor = page['cursor']
+            done = page['done']
+            records += page['messages']
+
+        return CheckpointState(header['max_id'], cursor, done, records)
+
+    def start(self, conversation_id, max_id):
+        """Create a new checkpoint, replacing any previous one"""
+
+        self.close()
+        self._file = open(self.filename, 'w', encoding='utf-8', newline='\n')
+        self._write({'conversation_id': conversation_id, 'max_id': max_id})
+
+    def resume(self):
+        """Reopen a loaded checkpoint to add pages to it"""
+
+        self.close()
+        with open(self.filename, 'rb+') as file:
+            # Drop a partially written page
+            file.truncate(self._valid_length)
+        self._file = open(self.filename, 'a', encoding='utf-8', newline='\n')
+
+    def append(self, cursor, done, records):
+        """Save a processed page and the cursor of the next one"""
+
+        self._write({'cursor': cursor, 'done': done, 'messages': records})
+
+    def _write(self, content):
+        self._file.write(json.dumps(content) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
@@ -20,21 +20,290 @@
       -dv, --download-videos
                             Download videos (as MP4)
       -r, --raw-output  Write the raw HTML to a file
+      -ho, --html-output
+                            Update the monthly HTML pages of the conversation
+      -pc PARSE_CACHE, --parse-cache PARSE_CACHE
+                            Cache the parsed messages in this file
+      --parse-cache-size PARSE_CACHE_SIZE
+                            Maximum size of the parse cache (MB)
+      --priority {recent,new,weight}
+                            Order of the conversations (default: recent)
+      --weights WEIGHTS     JSON file with the weight of each conversation ID
+      --time-budget TIME_BUDGET
+                            Stop crawling after this duration (seconds)
+      --request-budget REQUEST_BUDGET
+                            Stop crawling after this number of requests
+      --since SINCE         Retrieve only the messages sent from this date (YYYY-MM-DD)
+      --until UNTIL         Retrieve only the messages sent until this date (YYYY-MM-DD)
+      --author AUTHOR       Retrieve only the messages of this author (can be repeated)
+      --shard SHARD         Split the archive into one file per month ('month')
+                            or per number of records (e.g. 100000)
+
+    # dmarchiver verify [-h] [-j WORKERS] [-o OUTPUT] [CONVERSATION_ID ...]
+
+    Check the archives and the downloaded media against their manifest
+    and write the list of what must be fetched again as JSON.
+
+    # dmarchiver coordinator [-h] -q QUEUE -c CREDENTIALS [-d] [--status]
+    # dmarchiver worker [-h] -q QUEUE -c CREDENTIALS [-o OUTPUT_DIR] [-s]
+                        [-di] [-dg] [-dv] [-ho] [--shard SHARD]
+
+    Share the crawling of several accounts between workers running on
+    one or several machines, through a shared SQLite work queue.
+
+    # dmarchiver stats [-h] [--json] [--no-cache] [CONVERSATION_ID ...]
+
+    Compute the statistics of the archived conversations (requires NumPy).
 """
 
 import os
 import argparse
+import datetime
 import getpass
+import json
 import sys
 import time
+# Only the lightweight modules are imported here. The crawler (lxml,
+# requests) and the modules of the subcommands are imported when a
+# command needs them, to keep the startup fast (e.g. for '--help').
 if __name__ == '__main__':
     from dmarchiver import __version__
-    from dmarchiver.core import Crawler
+    from dmarchiver.scheduler import PRIORITIES
 else:
     from .__init__ import __version__
-    from .core import Crawler
+    from .scheduler import PRIORITIES
+
+def verify_main(arguments):
+    parser = argparse.ArgumentParser(
+        prog='dmarchiver verify',
+        description='Check the archives and the downloaded media against their manifest.')
+    parser.add_argument(
+        "conversation_ids",
+        nargs="*",
+        metavar="CONVERSATION_ID",
+        help="Conversation IDs (default: all the conversations of the current directory)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("-o", "--output", help="Write the list of the problems to a file instead of the standard output")
+
+    args = parser.parse_args(arguments)
+
+    if __name__ == '__main__':
+        from dmarchiver.verify import verify, find_conversations
+    else:
+        from .verify import verify, find_conversations
+
+    conversation_ids = [conversation_id.strip('\'') for conversation_id in args.conversation_ids]
+    if len(conversation_ids) == 0:
+        conversation_ids = find_conversations()
+
+    problems = verify(conversation_ids, args.workers)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(problems, file, indent=1)
+    else:
+        json.dump(problems, sys.stdout, indent=1)
+        print()
+
+    print('{0} conversation(s) verified, {1} problem(s) found.'.format(
+        len(conversation_ids), len(problems)), file=sys.stderr)
+    if len(problems) > 0:
+        sys.exit(1)
+
+def coordinator_main(arguments):
+    parser = argparse.ArgumentParser(
+        prog='dmarchiver coordinator',
+        description='Queue the conversations of several accounts for the workers.')
+    parser.add_argument("-q", "--queue", required=True, help="Work queue database (shared by the workers)")
+    parser.add_argument("-c", "--credentials", help="File with one 'username:password' per line")
+    parser.add_argument("-d", "--delay", type=float, default=0, help="Delay between requests for each account (seconds)")
+    parser.add_argument("--status", help="Print the state of the queue and exit", action="store_true")
+
+    args = parser.parse_args(arguments)
+
+    if __name__ == '__main__':
+        from dmarchiver.workqueue import WorkQueue, read_credentials
+    else:
+        from .workqueue import WorkQueue, read_credentials
+
+    queue = WorkQueue(args.queue)
+
+    if not args.status:
+        if args.credentials is None:
+            parser.error('the following arguments are required: -c/--credentials')
+
+        if __name__ == '__main__':
+            from dmarchiver.core import Crawler
+        else:
+            from .core import Crawler
+
+        for username, password in sorted(read_credentials(args.credentials).items()):
+            print('Retrieving the threads of \'{0}\''.format(username))
+            crawler = Crawler()
+            try:
+                crawler.authenticate(username, password, False, False)
+                threads = crawler.get_threads(args.delay, False)
+            except Exception as ex:
+                print('Error: {0}'.format(ex))
+                continue
+            queue.add_account(username, args.delay)
+            for thread_id in threads:
+                queue.add_job(username, thread_id)
+            print('{0} thread(s) queued.'.format(len(threads)))
+
+    for account, status, count in queue.status():
+        print('{0}: {1} {2}'.format(account, count, status))
+
+def worker_main(arguments):
+    parser = argparse.ArgumentParser(
+        prog='dmarchiver worker',
+        description='Crawl the conversations of the work queue.')
+    parser.add_argument("-q", "--queue", required=True, help="Work queue database (shared by the workers)")
+    parser.add_argument("-c", "--credentials", required=True, help="File with one 'username:password' per line")
+    parser.add_argument("-o", "--output-dir", default='.', help="Directory of the archives, with one folder per account")
+    parser.add_argument("-w", "--worker-id", help="Name of the worker (default: hostname and process ID)")
+    parser.add_argument("-s", "--save_session", help="Save the sessions locally.", action="store_true")
+    parser.add_argument("-di", "--download-images", help="Download images", action="store_true")
+    parser.add_argument("-dg", "--download-gifs", help="Download GIFs (as MP4)", action="store_true")
+    parser.add_argument("-dv", "--download-videos", help="Download videos (as MP4)", action="store_true")
+    parser.add_argument("-ho", "--html-output", help="Update the monthly HTML pages of the conversation", action="store_true")
+    parser.add_argument("-pc", "--parse-cache", help="Cache the parsed messages in this file")
+    parser.add_argument("--parse-cache-size", type=float, default=512, help="Maximum size of the parse cache (MB)")
+    parser.add_argument("--shard", help="Split the archives into one file per month ('month') or per number of records")
+
+    args = parser.parse_args(arguments)
+
+    if __name__ == '__main__':
+        from dmarchiver.workqueue import WorkQueue, Worker, read_credentials
+        from dmarchiver.parsecache import ParseCache
+        from dmarchiver.shards import parse_shard_mode
+    else:
+        from .workqueue import WorkQueue, Worker, read_credentials
+        from .parsecache import ParseCache
+        from .shards import parse_shard_mode
+
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard_mode(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+
+    parse_cache = None
+    if args.parse_cache is not None:
+        parse_cache = ParseCache(args.parse_cache, int(args.parse_cache_size * 1024 * 1024))
+
+    worker = Worker(
+        WorkQueue(args.queue),
+        read_credentials(args.credentials),
+        worker_id=args.worker_id,
+        output_dir=args.output_dir,
+        save_session=args.save_session,
+        parse_cache=parse_cache,
+        crawl_options={'download_images': args.download_images,
+                       'download_gifs': args.download_gifs,
+                       'download_videos': args.download_videos,
+                       'html_output': args.html_output,
+                       'shard': shard})
+    print('Worker \'{0}\' started.'.format(worker.worker_id))
+
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        print('Script execution interruption requested. Exiting.')
+        sys.exit()
+
+def stats_main(arguments):
+    parser = argparse.ArgumentParser(
+        prog='dmarchiver stats',
+        description='Compute the statistics of the archived conversations.')
+    parser.add_argument(
+        "conversation_ids",
+        nargs="*",
+        metavar="CONVERSATION_ID",
+        help="Conversation IDs (default: all the conversations of the current directory)")
+    parser.add_argument("--json", help="Write the statistics as JSON", action="store_true")
+    parser.add_argument("--no-cache", help="Do not read or write the cached arrays", action="store_true")
+
+    args = parser.parse_args(arguments)
+
+    if __name__ == '__main__':
+        from dmarchiver.verify import find_conversations
+        from dmarchiver.shards import archive_exists
+    else:
+        from .verify import find_conversations
+        from .shards import archive_exists
+
+    # NumPy is an optional dependency, only needed by this command
+    try:
+        if __name__ == '__main__':
+            from dmarchiver.stats import load_conversation, compute_statistics
+        else:
+            from .stats import load_conversation, compute_statistics
+    except ImportError:
+        print('Error: NumPy is required for the statistics. Install it with \'pip install dmarchiver[stats]\'.')
+        sys.exit(1)
+
+    conversation_ids = [conversation_id.strip('\'') for conversation_id in args.conversation_ids]
+    missing_ids = []
+    if len(conversation_ids) == 0:
+        conversation_ids = [conversation_id for conversation_id in find_conversations()
+                            if archive_exists(conversation_id)]
+    else:
+        missing_ids = [conversation_id for conversation_id in conversation_ids
+                       if not archive_exists(conversation_id)]
+        for conversation_id in missing_ids:
+            print('Error: no archive found for the conversation \'{0}\'.'.format(conversation_id),
+                  file=sys.stderr)
+        conversation_ids = [conversation_id for conversation_id in conversation_ids
+                            if conversation_id not in missing_ids]
+
+    statistics = compute_statistics(
+        [load_conversation(conversation_id, not args.no_cache) for conversation_id in conversation_ids])
+
+    if args.json:
+        json.dump(statistics, sys.stdout, indent=1)
+        print()
+        if len(missing_ids) > 0:
+            sys.exit(1)
+        return
+
+    print('Conversations: {0}'.format(statistics['conversations']))
+    print('Messages: {0} (from {1} to {2})'.format(
+        statistics['messages'], statistics['first_message'], statistics['last_message']))
+    print('{0}Messages per author:'.format(os.linesep))
+    for author, count in sorted(statistics['messages_per_author'].items(), key=lambda item: -item[1]):
+        print('  {0}: {1}'.format(author, count))
+    print('{0}Messages per hour:'.format(os.linesep))
+    for hour, count in enumerate(statistics['messages_per_hour']):
+        print('  {0:02d}h: {1}'.format(hour, count))
+    if len(statistics['messages_per_day']) > 0:
+        busiest_day = max(statistics['messages_per_day'].items(), key=lambda item: item[1])
+        print('{0}Active days: {1}, busiest: {2} ({3} messages)'.format(
+            os.linesep, len(statistics['messages_per_day']), busiest_day[0], busiest_day[1]))
+    print('{0}Elements:'.format(os.linesep))
+    for element_type, count in statistics['elements'].items():
+        print('  {0}: {1}'.format(element_type, count))
+    latency = statistics['response_latency']
+    if latency['count'] > 0:
+        print('{0}Response latency (seconds): median {1:.0f}, mean {2:.0f}, p90 {3:.0f}, p99 {4:.0f}'.format(
+            os.linesep, latency['median'], latency['mean'], latency['p90'], latency['p99']))
+        for label, count in latency['histogram'].items():
+            print('  {0}: {1}'.format(label, count))
+
+    if len(missing_ids) > 0:
+        sys.exit(1)
+
+_COMMANDS = {'verify': verify_main,
+             'coordinator': coordinator_main,
+             'worker': worker_main,
+             'stats': stats_main}
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+        _COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     print("DMArchiver {0}".format(__version__))
     print("Running on Python {0}{1}".format(sys.version, os.linesep))
     parser = argparse.ArgumentParser()
@@ -68,9 +337,60 @@ def main():
         "--raw-output",
         help="Write the raw HTML to a file",
         action="store_true")
+    parser.add_argument(
+        "-ho",
+        "--html-output",
+        help="Update the monthly HTML pages of the conversation",
+        action="store_true")
+    parser.add_argument("-pc", "--parse-cache", help="Cache the parsed messages in this file")
+    parser.add_argument("--parse-cache-size", type=float, default=512, help="Maximum size of the parse cache (MB)")
+    parser.add_argument("--priority", choices=PRIORITIES, default='recent', help="Order of the conversations (default: recent)")
+    parser.add_argument("--weights", help="JSON file with the weight of each conversation ID")
+    parser.add_argument("--time-budget", type=float, help="Stop crawling after this duration (seconds)")
+    parser.add_argument("--request-budget", type=int, help="Stop crawling after this number of requests")
+    parser.add_argument("--since", help="Retrieve only the messages sent from this date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="Retrieve only the messages sent until this date (YYYY-MM-DD)")
+    parser.add_argument("--author", action="append", help="Retrieve only the messages of this author (can be repeated)")
+    parser.add_argument("--shard", help="Split the archive into one file per month ('month') or per number of records")
 
     args = parser.parse_args()
 
+    if __name__ == '__main__':
+        from dmarchiver.core import Crawler
+        from dmarchiver.parsecache import ParseCache
+        from dmarchiver.scheduler import Scheduler
+        from dmarchiver.shards import parse_shard_mode
+    else:
+        from .core import Crawler
+        from .parsecache import ParseCache
+        from .scheduler import Scheduler
+        from .shards import parse_shard_mode
+
+    since = None
+    until = None
+    try:
+        if args.since is not None:
+            since = int(datetime.datetime.strptime(args.since, '%Y-%m-%d').timestamp())
+        if args.until is not None:
+            # Include the whole last day
+            until = int(datetime.datetime.strptime(args.until, '%Y-%m-%d').timestamp()) + 86399
+    except ValueError as err:
+        parser.error(str(err))
+    authors = set(args.author) if args.author is not None else None
+    selective = since is not None or until is not None or authors is not None
+
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard_mode(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+
+    weights = None
+    if args.weights is not None:
+        with open(args.weights, 'r', encoding='utf-8') as file:
+            weights = json.load(file)
+
     if args.save_session:
         print('Warning: Session saving is enabled. Your authentication cookie (Twitter credentials) will be kept in the dmarchiver_session.dat file.')
 
@@ -85,7 +405,11 @@ def main():
     else:
         password = args.password
 
-    crawler = Crawler()
+    parse_cache = None
+    if args.parse_cache is not None:
+        parse_cache = ParseCache(args.parse_cache, int(args.parse_cache_size * 1024 * 1024))
+
+    crawler = Crawler(parse_cache)
     try:
         crawler.authenticate(username, password, args.save_session, args.raw_output)
     except PermissionError as err:
@@ -95,6 +419,11 @@ def main():
 
     print('Press Ctrl+C at anytime to write the current conversation and skip to the next one.\n Keep it pressed to exit the script.\n')
 
+    deadline = None
+    if args.time_budget is not None:
+        deadline = time.time() + args.time_budget
+    remaining_requests = args.request_budget
+
     try:
         if args.conversation_id is not None:
             # Prevent error when using '' instead of ""
@@ -106,16 +435,44 @@ def main():
                 conversation_id,
                 args.delay,
                 args.download_images,
-                args.download_gifs, args.download_videos, args.raw_output)
+                args.download_gifs, args.download_videos, args.raw_output,
+                args.html_output, remaining_requests, deadline,
+                since, until, authors, shard)
         else:
             print('Conversation ID not specified. Retrieving all the threads.')
             threads = crawler.get_threads(args.delay, args.raw_output)
             print('{0} thread(s) found.'.format(len(threads)))
 
-            for thread_id in threads:
-                crawler.crawl(thread_id, args.delay, args.download_images,
-                              args.download_gifs, args.download_videos, args.raw_output)
-                time.sleep(args.delay)
+            scheduler = Scheduler(args.priority, weights)
+            time_budget = None
+            if deadline is not None:
+                time_budget = deadline - time.time()
+            planned_threads = scheduler.plan(threads, remaining_requests, time_budget)
+            if len(planned_threads) < len(threads):
+                print('{0} thread(s) planned within the budget, the others are left for the next run.'.format(
+                    len(planned_threads)))
+
+            try:
+                for thread_id in planned_threads:
+                    if (remaining_requests is not None and remaining_requests <= 0) or \
+                            (deadline is not None and time.time() >= deadline):
+                        print('Budget exhausted. Stopping.')
+                        break
+                    start_time = time.time()
+                    result = crawler.crawl(
+                        thread_id, args.delay, args.download_images,
+                        args.download_gifs, args.download_videos, args.raw_output,
+                        args.html_output, remaining_requests, deadline,
+                        since, until, authors, shard)
+                    # Selective crawls stop early and write their own file, they
+                    # say nothing about the work of the next complete crawls
+                    if not selective:
+                        scheduler.record(thread_id, result, time.time() - start_time)
+                    if remaining_requests is not None:
+                        remaining_requests -= result.requests
+                    time.sleep(args.delay)
+            finally:
+                scheduler.save()
     except KeyboardInterrupt:
         print('Script execution interruption requested. Exiting.')
         sys.exit()
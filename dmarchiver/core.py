@@ -14,16 +14,34 @@
 import collections
 import datetime
 from enum import Enum
+import hashlib
 import os
 import pickle
 import re
-import shutil
+import sqlite3
 from sys import platform
 import time
 import lxml.html
 import requests
 
-__all__ = ['Crawler']
+from .checkpoint import Checkpoint
+from .events import ConsoleReporter
+from .htmlexport import HtmlExporter
+from .manifest import Manifest
+from .reader import ArchiveReader, find_trailer
+from .shards import ShardedArchive
+
+__all__ = ['Crawler', 'CrawlResult', 'message_from_dict']
+
+# Outcome of a crawl: 'complete' is False when the crawl was stopped by
+# its budget and will continue from its checkpoint on the next run,
+# 'incremental' is True when the crawl updated a previous archive
+CrawlResult = collections.namedtuple(
+    'CrawlResult', ['complete', 'incremental', 'requests', 'processed_tweets'])
+
+# 'data-time' attribute of the span._timestamp tag of a message footer
+_FOOTER_TIMESTAMP_RE = re.compile(
+    r'<span(?=[^>]*\sclass="(?:[^"]*\s)?_timestamp[\s"])[^>]*\sdata-time="([0-9]+)"')
 
 # Expand short URL generated by Twitter
 
@@ -35,6 +53,33 @@ def expand_url(url):
     return response.headers['location']
 
 
+def message_from_dict(record):
+    """Return the DirectMessage or DMConversationEntry of a serialized message"""
+
+    if record['type'] == 'DMConversationEntry':
+        return DMConversationEntry(record['tweet_id'], record['text'])
+
+    message = DirectMessage(
+        record['tweet_id'], record['time_stamp'], record['author'])
+    message.elements = []
+    for element in record['elements']:
+        if element['type'] == 'text':
+            message.elements.append(DirectMessageText(element['text']))
+        elif element['type'] == 'tweet':
+            message.elements.append(DirectMessageTweet(element['url']))
+        elif element['type'] == 'card':
+            message.elements.append(DirectMessageCard(
+                element['url'], element['name'], element['expanded_url']))
+        elif element['type'] == 'media':
+            message.elements.append(DirectMessageMedia(
+                element['url'],
+                element['preview_url'],
+                element['alt'],
+                MediaType[element['media_type']],
+                element['filename']))
+    return message
+
+
 class Conversation(object):
     """This class is a representation of a complete conversation"""
 
@@ -66,10 +111,10 @@ class Conversation(object):
             elif type(tweet[1]).__name__ == 'DMConversationEntry':
                 print('[DMConversationEntry] {0}\r'.format(tweet[1]))
 
-    def write_conversation(self, filename, max_id):
-        """Write the content of the conversation to a file"""
-
-        file_buffer = ''
+    def format_items(self):
+        """Yield the local date (None for the DMConversationEntry items)
+        and the archive line of each item, from the oldest to the newest
+        """
 
         items = list(self.tweets.items())
         items.reverse()
@@ -78,43 +123,53 @@ class Conversation(object):
             if type(tweet[1]).__name__ == 'DirectMessage':
                 irc_formatted_date = datetime.datetime.fromtimestamp(
                     int(tweet[1].time_stamp)).strftime('%Y-%m-%d %H:%M:%S')
-                file_buffer += '[{0}] <{1}> '.format(
+                line = '[{0}] <{1}> '.format(
                     irc_formatted_date, tweet[1].author)
                 for element in tweet[1].elements:
                     # Convert all '\n' of the buffer to os.linesep
                     # to handle tweets on multiple lines
-                    file_buffer += '{0} '.format(
+                    line += '{0} '.format(
                         element).replace('\n', os.linesep)
 
-                # Remove the last space of the line
-                file_buffer = file_buffer[:-1]
-
-                # Add the end of line character
-                file_buffer += '{0}'.format(os.linesep)
+                # Remove the last space of the line and add the end of
+                # line character
+                yield irc_formatted_date, line[:-1] + os.linesep
             elif type(tweet[1]).__name__ == 'DMConversationEntry':
-                file_buffer += '[DMConversationEntry] {0}{1}'.format(
+                yield None, '[DMConversationEntry] {0}{1}'.format(
                     tweet[1], os.linesep)
 
+    def get_latest_tweet_id(self):
+        return next(iter(self.tweets)) if len(self.tweets) > 0 else None
+
+    def write_conversation(self, filename, max_id):
+        """Write the content of the conversation to a file"""
+
+        file_buffer = [line for date, line in self.format_items()]
+
         # Write the latest tweet ID to allow incremental updates
-        if len(items) > 0:
-            file_buffer += '[LatestTweetID] {0}{1}'.format(
-                tweet[1].tweet_id, os.linesep)
+        if len(self.tweets) > 0:
+            file_buffer.append('[LatestTweetID] {0}{1}'.format(
+                self.get_latest_tweet_id(), os.linesep))
             if max_id != '0':
-                with open(filename, 'rb+') as file:
-                    lines = file.readlines()
-                    # Remove last line and rewrite the file (poor
-                    # performance...)
-                    lines = lines[:-1]
-                    file.seek(0)
-                    file.write(b''.join(lines))
-                    file.truncate()
+                # Remove the previous [LatestTweetID] line, found from the
+                # end of the file without reading the whole archive
+                trailer = find_trailer(filename)
+                if trailer is not None:
+                    with open(filename, 'rb+') as file:
+                        file.truncate(trailer[0])
 
             file_mode = "ab"
             if max_id == '0':
                 file_mode = "wb"
 
             with open(filename, file_mode) as file:
-                file.write(file_buffer.encode('UTF-8'))
+                file.write(''.join(file_buffer).encode('UTF-8'))
+
+    def write_shards(self, archive):
+        """Append the content of the conversation to a ShardedArchive"""
+
+        if len(self.tweets) > 0:
+            archive.append(self.format_items(), self.get_latest_tweet_id())
 
 
 class DMConversationEntry(object):
@@ -134,6 +189,13 @@ class DMConversationEntry(object):
     def __str__(self):
         return self._text
 
+    def to_dict(self):
+        """Return a serializable representation of the entry"""
+
+        return {'type': 'DMConversationEntry',
+                'tweet_id': self.tweet_id,
+                'text': self._text}
+
 
 class DirectMessage(object):
     """This class is a representation of a Direct Message (a tweet)"""
@@ -148,6 +210,15 @@ class DirectMessage(object):
         self.time_stamp = time_stamp
         self.author = author
 
+    def to_dict(self):
+        """Return a serializable representation of the message"""
+
+        return {'type': 'DirectMessage',
+                'tweet_id': self.tweet_id,
+                'time_stamp': self.time_stamp,
+                'author': self.author,
+                'elements': [element.to_dict() for element in self.elements]}
+
 
 class DirectMessageText(object):
     """ This class is a representation of simple text message.
@@ -162,6 +233,9 @@ class DirectMessageText(object):
     def __str__(self):
         return self._text
 
+    def to_dict(self):
+        return {'type': 'text', 'text': self._text}
+
 
 class DirectMessageTweet(object):
     """ This class is a representation of a quoted tweet.
@@ -176,6 +250,9 @@ class DirectMessageTweet(object):
     def __str__(self):
         return '[Tweet] {0}'.format(self._tweet_url)
 
+    def to_dict(self):
+        return {'type': 'tweet', 'url': self._tweet_url}
+
 
 class DirectMessageCard(object):
     """ This class is a representation of a card.
@@ -187,10 +264,12 @@ class DirectMessageCard(object):
     _card_name = ''
     _expanded_url = ''
 
-    def __init__(self, card_url, card_name):
+    def __init__(self, card_url, card_name, expanded_url=None):
         self._card_url = card_url
         self._card_name = card_name
-        if 'https://t.co/' in card_url:
+        if expanded_url is not None:
+            self._expanded_url = expanded_url
+        elif 'https://t.co/' in card_url:
             self._expanded_url = expand_url(card_url)
         else:
             self._expanded_url = card_url
@@ -198,6 +277,12 @@ class DirectMessageCard(object):
     def __str__(self):
         return '[Card-{1}] {0}'.format(self._expanded_url, self._card_name)
 
+    def to_dict(self):
+        return {'type': 'card',
+                'url': self._card_url,
+                'name': self._card_name,
+                'expanded_url': self._expanded_url}
+
 
 class MediaType(Enum):
     """ This class is a representation of the possible media types."""
@@ -218,12 +303,14 @@ class DirectMessageMedia(object):
     _media_url = ''
     _media_alt = ''
     _media_type = ''
+    _media_filename = ''
 
-    def __init__(self, media_url, media_preview_url, media_alt, media_type):
+    def __init__(self, media_url, media_preview_url, media_alt, media_type, media_filename=''):
         self._media_url = media_url
         self._media_preview_url = media_preview_url
         self._media_alt = media_alt
         self._media_type = media_type
+        self._media_filename = media_filename
 
     def __repr__(self):
         # Todo
@@ -244,6 +331,14 @@ class DirectMessageMedia(object):
             return '[Media-{0}] {1}'.format(
                 self._media_type.name, self._media_url)
 
+    def to_dict(self):
+        return {'type': 'media',
+                'media_type': self._media_type.name,
+                'url': self._media_url,
+                'preview_url': self._media_preview_url,
+                'alt': self._media_alt,
+                'filename': self._media_filename}
+
 
 class Crawler(object):
     """ This class is a main component of the tool.
@@ -267,6 +362,14 @@ class Crawler(object):
 
     _max_id_found = False
     _session = None
+    _parse_cache = None
+    _listener = None
+
+    def __init__(self, parse_cache=None, listener=None):
+        self._parse_cache = parse_cache
+        if listener is None:
+            listener = ConsoleReporter()
+        self._listener = listener
 
     def authenticate(self, username, password, save_session, raw_output):
         login_url = self._twitter_base_url + '/login'
@@ -277,16 +380,16 @@ class Crawler(object):
             try:
                 with open('dmarchiver_session.dat', 'rb') as file:
                     self._session = pickle.load(file)
-                    print('dmarchiver_session.dat found. Reusing a previous session, ignoring the provided credentials.')
+                    self._listener.info('dmarchiver_session.dat found. Reusing a previous session, ignoring the provided credentials.')
                     # Test if the session is still valid
                     response = self._session.get(messages_url, headers=self._http_headers, allow_redirects=False)
                     if response.status_code == 200:
                         return
                     else:
                         self._session = None
-                        print('Previous session is invalid. Creating a new session with provided credentials.')
+                        self._listener.info('Previous session is invalid. Creating a new session with provided credentials.')
             except FileNotFoundError:
-                print('dmarchiver_session.dat not found. Creating a new session with provided credentials.')
+                self._listener.info('dmarchiver_session.dat not found. Creating a new session with provided credentials.')
 
         if save_session is False or self._session is None:
             self._session = requests.Session()
@@ -317,7 +420,7 @@ class Crawler(object):
             params=payload)
         cookies = requests.utils.dict_from_cookiejar(self._session.cookies)
         if 'auth_token' in cookies:
-            print('Authentication succeedeed.{0}'.format(os.linesep))
+            self._listener.info('Authentication succeedeed.{0}'.format(os.linesep))
             
             if save_session:
                 # Saving the session locally
@@ -348,13 +451,13 @@ class Crawler(object):
             json = response.json()
 
             if 'errors' in json:
-                print('An error occured during the parsing of the conversions.\n')
+                self._listener.error('An error occured during the parsing of the conversions.\n')
                 if json['errors'][0]['code'] == 326:
-                    print('''DMArchiver was identified as suspicious and your account as been temporarily locked by Twitter.
+                    self._listener.error('''DMArchiver was identified as suspicious and your account as been temporarily locked by Twitter.
 Don\'t worry, you can unlock your account by following the intructions on the Twitter website.
 Maybe it\'s the first time you use it or maybe you have a lot of messages.
 You can unlock your account and try again, and possibly use the -d option to slow down the tool.\n''')
-                print('''Twitter error details below:
+                self._listener.error('''Twitter error details below:
 Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message']))
                 raise Exception('Stopping execution due to parsing error while retrieving the conversations')
 
@@ -382,7 +485,7 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                         json['trusted']['min_entry_id']
                 
             except KeyError as ex:
-                print(
+                self._listener.error(
                     'Unable to fully parse the list of the conversations. \
                      Maybe your account is locked or Twitter has updated the HTML code. \
                      Use -r to get the raw output and post an issue on GitHub. \
@@ -398,23 +501,71 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
     def _get_latest_tweet_id(self, thread_id):
         filename = '{0}.txt'.format(thread_id)
         try:
-            with open(filename, 'rb+') as file:
-                lines = file.readlines()
-                regex = r"^\[LatestTweetID\] ([0-9]+)"
-                result = re.match(regex, lines[-1].decode('utf-8'))
-
-                if result:
-                    print('Latest tweet ID found in previous dump. Incremental update.')
-                    return result.group(1)
-                else:
-                    print(
-                        'Latest tweet ID not found in previous dump. Creating a new one with incremental support.')
+            trailer = find_trailer(filename)
+
+            if trailer is not None:
+                self._listener.info('Latest tweet ID found in previous dump. Incremental update.')
+                return trailer[1]
+            else:
+                self._listener.info(
+                    'Latest tweet ID not found in previous dump. Creating a new one with incremental support.')
         except IOError:
-            print(
+            self._listener.info(
                 "Previous conversation not found. Creating a new one with incremental support.")
 
         return '0'
 
+    def _seed_html_export(self, conversation_id, sharded_archive):
+        """Render the previous archive of the conversation as HTML pages
+        if they do not exist yet
+        """
+
+        exporter = HtmlExporter(conversation_id)
+        if exporter.exists():
+            return
+
+        self._listener.info('Rendering the previous messages in {0}'.format(
+            os.path.join(os.getcwd(), conversation_id, 'html')))
+        if sharded_archive is not None:
+            exporter.import_archive(sharded_archive.records(), self._manifest.media)
+        else:
+            with ArchiveReader('{0}.txt'.format(conversation_id)) as reader:
+                exporter.import_archive(reader, self._manifest.media)
+
+    def _get_sharded_latest_tweet_id(self, sharded_archive):
+        """Return the latest tweet ID of a sharded archive, after splitting
+        the text archive of the conversation if it was not sharded yet
+        """
+
+        filename = '{0}.txt'.format(sharded_archive.conversation_id)
+        if not sharded_archive.exists() and os.path.isfile(filename) and \
+                find_trailer(filename) is not None:
+            self._listener.info('Splitting {0} into shards.'.format(filename))
+            sharded_archive.import_archive(filename)
+            # Keep the original file but stop using it
+            os.replace(filename, '{0}.migrated'.format(filename))
+
+        if sharded_archive.latest_tweet_id is not None:
+            self._listener.info('Latest tweet ID found in the shard index. Incremental update.')
+            return sharded_archive.latest_tweet_id
+
+        self._listener.info(
+            'Sharded conversation not found. Creating a new one with incremental support.')
+        return '0'
+
+    def _get_selection_name(self, conversation_id, since, until, authors):
+        """Return the name of the output file of a selective crawl"""
+
+        parts = [conversation_id]
+        if since is not None:
+            parts.append('from-' + datetime.datetime.fromtimestamp(since).strftime('%Y%m%d'))
+        if until is not None:
+            parts.append('to-' + datetime.datetime.fromtimestamp(until).strftime('%Y%m%d'))
+        if authors is not None:
+            parts.append('by-' + '+'.join(
+                re.sub(r'[^\w.@]', '_', author) for author in sorted(authors)))
+        return '-'.join(parts)
+
     def _extract_dm_text_url(self, element, expanding_mode='only_expanded'):
         raw_url = ''
         if expanding_mode == 'only_expanded':
@@ -470,6 +621,83 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                     dm_text += text.text
         return DirectMessageText(dm_text)
 
+    def _download_media(self, url, folder, media_filename, tweet_id):
+        """Download a media of the current conversation and record its
+        size and hash in the manifest.
+        """
+
+        path = '{0}/{1}'.format(folder, media_filename)
+        self._listener.media_queued(self._conversation_id, url, path)
+
+        response = self._session.get(url, stream=True)
+        if response.status_code != 200:
+            # The message does not include the URL, so the console prints
+            # it once for all the media
+            self._listener.warning('Unable to download a media (HTTP {0})'.format(
+                response.status_code))
+            self._listener.media_failed(
+                self._conversation_id, url, path, response.status_code)
+            return
+
+        # The announced length is only comparable when the body is not encoded
+        expected_size = None
+        if 'content-encoding' not in response.headers and 'content-length' in response.headers:
+            expected_size = int(response.headers['content-length'])
+
+        # Recorded without hash until the download is complete, so that an
+        # interrupted download is reported as truncated by 'verify'
+        self._manifest.add_media(path, tweet_id, url, expected_size or 0, None)
+
+        os.makedirs(
+            '{0}/{1}'.format(self._conversation_id, folder), exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with open('{0}/{1}/{2}'.format(self._conversation_id, folder, media_filename), 'wb') as file:
+            response.raw.decode_content = True
+            for chunk in iter(lambda: response.raw.read(65536), b''):
+                digest.update(chunk)
+                file.write(chunk)
+                size += len(chunk)
+
+        if expected_size is None:
+            expected_size = size
+
+        self._manifest.add_media(
+            path,
+            tweet_id,
+            url,
+            expected_size,
+            digest.hexdigest() if size == expected_size else None)
+        self._listener.media_completed(self._conversation_id, url, path, size)
+
+    def _download_cached_media(
+            self,
+            message,
+            download_images,
+            download_gifs,
+            download_videos):
+        """Download the missing media of a message restored from the cache"""
+
+        for element in message.elements:
+            if type(element).__name__ != 'DirectMessageMedia' or element._media_filename == '':
+                continue
+
+            media_type = element._media_type
+            if media_type in (MediaType.image, MediaType.sticker) and download_images:
+                folder, url = 'images', element._media_url
+            elif media_type == MediaType.gif and download_gifs:
+                folder, url = 'mp4-gifs', element._media_url
+            elif media_type == MediaType.video and download_videos:
+                folder = 'mp4-videos'
+                url = 'https://mobile.twitter.com/messages/media/' + message.tweet_id
+            else:
+                continue
+
+            if not os.path.isfile('{0}/{1}/{2}'.format(
+                    self._conversation_id, folder, element._media_filename)):
+                self._download_media(
+                    url, folder, element._media_filename, message.tweet_id)
+
     def _parse_dm_media(
             self,
             element,
@@ -482,6 +710,7 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
         media_preview_url = ''
         media_alt = ''
         media_type = MediaType.unknown
+        media_filename = None
 
         formatted_timestamp = datetime.datetime.fromtimestamp(
             int(time_stamp)).strftime('%Y%m%d-%H%M%S')
@@ -507,15 +736,10 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                 media_filename = 'sticker-' + media_sticker_filename_re[0]
             else:
                 # Unknown media type
-                print("Unknown media type")
+                self._listener.warning("Unknown media type")
             if media_filename is not None and download_images:
-                response = self._session.get(media_url, stream=True)
-                if response.status_code == 200:
-                    os.makedirs(
-                        '{0}/images'.format(self._conversation_id), exist_ok=True)
-                    with open('{0}/images/{1}'.format(self._conversation_id, media_filename), 'wb') as file:
-                        response.raw.decode_content = True
-                        shutil.copyfileobj(response.raw, file)
+                self._download_media(
+                    media_url, 'images', media_filename, tweet_id)
         elif len(gif_url) > 0:
             media_type = MediaType.gif
             media_style = gif_url[0].find('div').get('style')
@@ -527,13 +751,8 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                 0], media_filename_re[0][1])
 
             if download_gifs:
-                response = self._session.get(media_url, stream=True)
-                if response.status_code == 200:
-                    os.makedirs(
-                        '{0}/mp4-gifs'.format(self._conversation_id), exist_ok=True)
-                    with open('{0}/mp4-gifs/{1}'.format(self._conversation_id, media_filename), 'wb') as file:
-                        response.raw.decode_content = True
-                        shutil.copyfileobj(response.raw, file)
+                self._download_media(
+                    media_url, 'mp4-gifs', media_filename, tweet_id)
         elif len(video_url) > 0:
             media_type = MediaType.video
             media_style = video_url[0].find('div').get('style')
@@ -544,18 +763,14 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                 formatted_timestamp, tweet_id)
 
             if download_videos:
-                response = self._session.get(video_url, stream=True)
-                if response.status_code == 200:
-                    os.makedirs(
-                        '{0}/mp4-videos'.format(self._conversation_id), exist_ok=True)
-                    with open('{0}/mp4-videos/{1}'.format(self._conversation_id, media_filename), 'wb') as file:
-                        response.raw.decode_content = True
-                        shutil.copyfileobj(response.raw, file)
+                self._download_media(
+                    video_url, 'mp4-videos', media_filename, tweet_id)
 
         else:
-            print('Unknown media')
+            self._listener.warning('Unknown media')
 
-        return DirectMessageMedia(media_url, media_preview_url, media_alt, media_type)
+        return DirectMessageMedia(
+            media_url, media_preview_url, media_alt, media_type, media_filename or '')
 
     def _parse_dm_tweet(self, element):
         tweet_url = ''
@@ -572,7 +787,36 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
             card.get('data-card-url'),
             card.get('data-card-name'))
 
-    def _process_tweets(self, tweets, download_images, download_gifs, download_videos, max_id):
+    def _get_tweet_time(self, value):
+        """Return the timestamp of a tweet from its raw HTML, without parsing it"""
+
+        # Quoted tweets and cards have their own timestamps, only the one
+        # of the footer of the message is used, as in _process_tweets
+        footer = value.find('DirectMessage-footer')
+        if footer < 0:
+            return None
+        result = _FOOTER_TIMESTAMP_RE.search(value, footer)
+        if result is None:
+            return None
+        return int(result.group(1))
+
+    def _is_page_older(self, tweets, since):
+        """Return True if all the tweets of a page were sent before 'since'"""
+
+        time_stamps = [self._get_tweet_time(value) for value in tweets.values()]
+        time_stamps = [time_stamp for time_stamp in time_stamps if time_stamp is not None]
+        return len(time_stamps) > 0 and max(time_stamps) < since
+
+    def _process_tweets(
+            self,
+            tweets,
+            download_images,
+            download_gifs,
+            download_videos,
+            max_id,
+            since=None,
+            until=None,
+            authors=None):
         conversation_set = collections.OrderedDict()
         ordered_tweets = sorted(tweets, reverse=True)
 
@@ -584,7 +828,7 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
 
         for tweet_id in ordered_tweets:
             dm_author = ''
-            message = ''
+            message = None
             dm_element_text = ''
             value = tweets[tweet_id]
 
@@ -592,9 +836,34 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
             # we stop the execution
             if tweet_id == max_id:
                 self._max_id_found = True
-                print('Previous tweet limit found.')
+                self._listener.info('Previous tweet limit found.')
                 break
 
+            # Skip the tweets out of the selected period before parsing them
+            if since is not None or until is not None:
+                time_stamp = self._get_tweet_time(value)
+                if time_stamp is not None and \
+                        ((since is not None and time_stamp < since) or
+                         (until is not None and time_stamp > until)):
+                    continue
+
+            # Messages never change, skip the parsing of the known ones
+            if self._parse_cache is not None:
+                try:
+                    record = self._parse_cache.get(tweet_id, value)
+                except sqlite3.Error as ex:
+                    self._listener.warning('Unable to read the parse cache: {0}'.format(ex))
+                    record = None
+                if record is not None:
+                    message = message_from_dict(record)
+                    if authors is not None and getattr(message, 'author', None) not in authors:
+                        continue
+                    if type(message).__name__ == 'DirectMessage':
+                        self._download_cached_media(
+                            message, download_images, download_gifs, download_videos)
+                    conversation_set[tweet_id] = message
+                    continue
+
             try:
                 document = lxml.html.fragment_fromstring(value)
 
@@ -611,7 +880,8 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                         'img.DMAvatar-image')[0]
                     dm_author = dm_avatar.get('alt')
 
-                    # print(dm_author)
+                    if authors is not None and dm_author not in authors:
+                        continue
 
                     dm_footer = document.cssselect('div.DirectMessage-footer')
                     time_stamp = dm_footer[0].cssselect('span._timestamp')[
@@ -644,22 +914,33 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                             element_object = self._parse_dm_card(dm_element)
                             message.elements.append(element_object)
                         else:
-                            print('Unknown element type')
+                            self._listener.warning('Unknown element type')
 
                 elif len(dm_conversation_entry) > 0:
+                    # Entries have no author
+                    if authors is not None:
+                        continue
                     dm_element_text = dm_conversation_entry[0].text.strip()
                     message = DMConversationEntry(tweet_id, dm_element_text)
             except KeyboardInterrupt:
-                print(
+                self._listener.info(
                     'Script execution interruption requested. Writing the conversation.')
                 self._max_id_found = True
                 break
             except:
-                print(
+                self._listener.error(
                     'Unexpected error for tweet \'{0}\', raw HTML will be used for the tweet.'.format(tweet_id))
                 message = DMConversationEntry(
                     tweet_id, '[ParseError] Parsing of tweet \'{0}\' failed. Raw HTML: {1}'.format(
                         tweet_id, value))
+            else:
+                # A cache failure (e.g. a database locked by another worker)
+                # must not turn a parsed message into a parse error
+                if message is not None and self._parse_cache is not None:
+                    try:
+                        self._parse_cache.put(tweet_id, value, message.to_dict())
+                    except sqlite3.Error as ex:
+                        self._listener.warning('Unable to update the parse cache: {0}'.format(ex))
 
             if message is not None:
                 conversation_set[tweet_id] = message
@@ -673,7 +954,33 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
             download_images=False,
             download_gifs=False,
             download_videos=False,
-            raw_output=False):
+            raw_output=False,
+            html_output=False,
+            max_requests=None,
+            deadline=None,
+            since=None,
+            until=None,
+            authors=None,
+            shard=None,
+            stop_event=None):
+        """Retrieve the new messages of a conversation and write them.
+
+        The crawl stops before 'max_requests' requests or at the 'deadline'
+        (a time.time() value). In this case, the conversation is not
+        written and the next crawl continues from the checkpoint. The crawl
+        also stops this way when 'stop_event' (a threading.Event) is set.
+
+        'since' and 'until' (Unix timestamps) and 'authors' (a set of names)
+        select the messages to retrieve. A selective crawl is written to
+        its own file, e.g. '<conversation_id>-from-20170101.txt', and does
+        not update the incremental archive or the HTML pages of the
+        conversation.
+
+        'shard' ('month' or a number of records) writes the conversation
+        to the shards of '<conversation_id>/shards' instead of a single
+        '<conversation_id>.txt' file. An existing text archive is split
+        into shards first, and a sharded conversation stays sharded.
+        """
 
         raw_output_file = None
 
@@ -681,20 +988,65 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
             raw_output_file = open(
                 '{0}-raw.txt'.format(conversation_id), 'wb')
 
-        print('{0}Starting crawl of \'{1}\''.format(
+        self._listener.info('{0}Starting crawl of \'{1}\''.format(
             os.linesep, conversation_id))
-
-        # Attempt to find the latest tweet id of a previous crawl session
-        max_id = self._get_latest_tweet_id(conversation_id)
+        self._listener.crawl_started(conversation_id)
+
+        selective = since is not None or until is not None or authors is not None
+        output_name = conversation_id
+        if selective:
+            output_name = self._get_selection_name(conversation_id, since, until, authors)
+            self._listener.info('Selective crawl, writing only to {0}.txt'.format(output_name))
+            max_id = '0'
+            sharded_archive = None
+        else:
+            sharded_archive = ShardedArchive(conversation_id, shard or 'month')
+            if sharded_archive.exists() or shard is not None:
+                max_id = self._get_sharded_latest_tweet_id(sharded_archive)
+            else:
+                sharded_archive = None
+                # Attempt to find the latest tweet id of a previous crawl session
+                max_id = self._get_latest_tweet_id(conversation_id)
 
         self._conversation_id = conversation_id
+        self._manifest = Manifest.load(conversation_id)
         conversation = Conversation(conversation_id)
         conversation_url = self._twitter_base_url + '/messages/with/conversation'
         payload = {'id': conversation_id}
         processed_tweet_counter = 0
+        page_number = 0
+        request_counter = 0
+        budget_exhausted = False
+        stopped = False
+
+        # Resume an interrupted crawl from its last saved page
+        checkpoint = Checkpoint('{0}.checkpoint'.format(output_name))
+        state = checkpoint.load()
+        if state is not None and state.max_id == max_id:
+            for record in state.records:
+                conversation.tweets[record['tweet_id']] = message_from_dict(record)
+            processed_tweet_counter = len(conversation.tweets)
+            if state.cursor is not None:
+                payload = {'id': conversation_id, 'max_entry_id': state.cursor}
+            self._max_id_found = state.done
+            self._listener.info('Checkpoint found. Resuming the crawl after {0} processed tweets.'.format(
+                processed_tweet_counter))
+            checkpoint.resume()
+        else:
+            checkpoint.start(conversation_id, max_id)
+        saved_media_count = len(self._manifest.media)
 
         try:
             while True and self._max_id_found is False:
+                if (max_requests is not None and request_counter >= max_requests) or \
+                        (deadline is not None and time.time() >= deadline):
+                    budget_exhausted = True
+                    break
+                if stop_event is not None and stop_event.is_set():
+                    stopped = True
+                    break
+
+                request_counter += 1
                 response = self._session.get(
                     conversation_url,
                     headers=self._ajax_headers,
@@ -703,24 +1055,32 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
                 json = response.json()
 
                 if 'errors' in json:
-                    print('An error occured during the parsing of the tweets.\n')
+                    self._listener.error('An error occured during the parsing of the tweets.\n')
                     if json['errors'][0]['code'] == 326:
-                        print('''DMArchiver was identified as suspicious and your account as been temporarily locked by Twitter.
+                        self._listener.error('''DMArchiver was identified as suspicious and your account as been temporarily locked by Twitter.
 Don\'t worry, you can unlock your account by following the intructions on the Twitter website.
 Maybe it\'s the first time you use it or maybe you have a lot of messages.
 You can unlock your account and try again, and possibly use the -d option to slow down the tool.\n''')
-                    print('''Twitter error details below:
+                    self._listener.error('''Twitter error details below:
 Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message']))
                     raise Exception('Stopping execution due to parsing error while retrieving the tweets.')
 
                 if 'max_entry_id' not in json:
-                    print('Begin of thread reached')
+                    self._listener.info('Begin of thread reached')
                     break
 
                 payload = {'id': conversation_id,
                            'max_entry_id': json['min_entry_id']}
 
                 tweets = json['items']
+                page_number += 1
+                self._listener.page_fetched(
+                    conversation_id, page_number, len(tweets))
+
+                # Pages are retrieved backward, the next ones are older
+                if since is not None and self._is_page_older(tweets, since):
+                    self._listener.info('Beginning of the selected period reached')
+                    break
 
                 if raw_output:
                     ordered_tweets = sorted(tweets, reverse=True)
@@ -729,31 +1089,106 @@ Code {0}: {1}\n'''.format(json['errors'][0]['code'], json['errors'][0]['message'
 
                 # Get tweets for the current request
                 conversation_set = self._process_tweets(
-                    tweets, download_images, download_gifs, download_videos, max_id)
+                    tweets, download_images, download_gifs, download_videos, max_id,
+                    since, until, authors)
 
                 # Append to the whole conversation
                 for tweet_id in conversation_set:
                     processed_tweet_counter += 1
                     conversation.tweets[tweet_id] = conversation_set[tweet_id]
-                    print('Processed tweets: {0}\r'.format(
-                        processed_tweet_counter), end='')
-            
+                    self._listener.message_parsed(
+                        conversation_id, conversation_set[tweet_id], processed_tweet_counter)
+
+                if self._parse_cache is not None:
+                    try:
+                        self._parse_cache.commit()
+                    except sqlite3.Error as ex:
+                        self._listener.warning('Unable to update the parse cache: {0}'.format(ex))
+
+                # Save the page to continue from here after a failure
+                checkpoint.append(
+                    json['min_entry_id'],
+                    self._max_id_found,
+                    [conversation_set[tweet_id].to_dict() for tweet_id in conversation_set])
+                if len(self._manifest.media) != saved_media_count:
+                    self._manifest.save()
+                    saved_media_count = len(self._manifest.media)
+
                 time.sleep(delay)
         except KeyboardInterrupt:
-            print(
+            self._listener.info(
                 'Script execution interruption requested. Writing this conversation.')
+        except:
+            checkpoint.close()
+            # Keep the media downloaded or interrupted until the failure
+            if len(self._manifest.media) > 0:
+                self._manifest.save()
+            self._max_id_found = False
+            raise
 
         if raw_output:
             raw_output_file.close()
 
-        print('Total processed tweets: {0}'.format(processed_tweet_counter))
+        self._listener.crawl_finished(conversation_id, processed_tweet_counter)
+
+        if budget_exhausted or stopped:
+            if stopped:
+                self._listener.info(
+                    'Crawl stopped. The crawl of this conversation will continue on the next run.')
+            else:
+                self._listener.info(
+                    'Budget exhausted. The crawl of this conversation will continue on the next run.')
+            checkpoint.close()
+            return CrawlResult(False, max_id != '0', request_counter, processed_tweet_counter)
 
         # print('Printing conversation')
         # conversation.print_conversation()
 
-        print('Writing conversation to {0}.txt'.format(
-            os.path.join(os.getcwd(), conversation_id)))
-        conversation.write_conversation(
-            '{0}.txt'.format(conversation_id), max_id)
+        if html_output and selective:
+            # The pages of the conversation must not receive only a selection
+            self._listener.info('Selective crawl, the HTML archive is not updated')
+            html_output = False
+
+        if html_output and max_id != '0':
+            # The HTML pages of a conversation archived without them start
+            # from the previous archive, before the new messages are added
+            self._seed_html_export(conversation_id, sharded_archive)
+
+        if sharded_archive is not None:
+            self._listener.info('Writing conversation to {0}'.format(
+                os.path.join(os.getcwd(), sharded_archive.directory)))
+            conversation.write_shards(sharded_archive)
+        else:
+            self._listener.info('Writing conversation to {0}.txt'.format(
+                os.path.join(os.getcwd(), output_name)))
+            conversation.write_conversation(
+                '{0}.txt'.format(output_name), max_id)
+
+        if len(conversation.tweets) > 0 and not selective:
+            # The message count is unknown for archives written without a manifest
+            message_count = None
+            if max_id == '0':
+                message_count = len(conversation.tweets)
+            elif self._manifest.latest_tweet_id == max_id and self._manifest.message_count is not None:
+                message_count = self._manifest.message_count + len(conversation.tweets)
+            self._manifest.set_archive(
+                next(iter(conversation.tweets)), message_count)
+        if (len(conversation.tweets) > 0 and not selective) or len(self._manifest.media) > 0:
+            self._manifest.save()
+
+        checkpoint.remove()
+
+        if html_output:
+            self._listener.info('Updating HTML archive in {0}'.format(
+                os.path.join(os.getcwd(), conversation_id, 'html')))
+            exporter = HtmlExporter(conversation_id)
+            if max_id == '0' and exporter.exists():
+                # A crawl from scratch rewrites the archive. The pages are
+                # rebuilt too, the messages rendered from the previous
+                # archive have no real tweet IDs and would be duplicated.
+                exporter.clear()
+            exporter.export(conversation.tweets.values())
 
         self._max_id_found = False
+
+        return CrawlResult(True, max_id != '0', request_counter, processed_tweet_counter)
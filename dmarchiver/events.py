@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Events
+
+    The crawler reports its progress, warnings and errors to a listener
+    instead of printing them. Subclass CrawlerListener and override the
+    methods you are interested in to collect them.
+
+    Usage:
+
+    >>> from dmarchiver.core import Crawler
+    >>> from dmarchiver.events import CrawlerListener
+    >>> class MediaCounter(CrawlerListener):
+    ...     count = 0
+    ...     def media_completed(self, conversation_id, url, path, size):
+    ...         self.count += 1
+    >>> crawler = Crawler(listener=MediaCounter())
+"""
+
+import collections
+import sys
+import time
+
+__all__ = ['CrawlerListener', 'ConsoleReporter']
+
+
+class CrawlerListener(object):
+    """This class is the base of the listeners of a crawler.
+    All the events are ignored by default.
+    """
+
+    def info(self, message):
+        """A general information, e.g. about the authentication"""
+
+    def warning(self, message):
+        """A problem which does not stop the crawl, e.g. an unknown media type"""
+
+    def error(self, message):
+        """A problem which stops the crawl or loses a message"""
+
+    def crawl_started(self, conversation_id):
+        pass
+
+    def page_fetched(self, conversation_id, page_number, tweet_count):
+        pass
+
+    def message_parsed(self, conversation_id, message, processed_count):
+        pass
+
+    def media_queued(self, conversation_id, url, path):
+        pass
+
+    def media_completed(self, conversation_id, url, path, size):
+        pass
+
+    def media_failed(self, conversation_id, url, path, status_code):
+        """A media could not be downloaded (HTTP status other than 200)"""
+
+    def crawl_finished(self, conversation_id, processed_count):
+        pass
+
+
+class ConsoleReporter(CrawlerListener):
+    """This class prints the events to the console.
+
+    The progress line is refreshed at most once per 'interval' seconds and
+    a warning is printed only the first time it occurs, with the number of
+    occurrences at the end of the crawl, so the output does not grow with
+    the number of messages.
+    """
+
+    def __init__(self, interval=0.5, file=None):
+        self._interval = interval
+        self._file = file
+        self._last_progress = 0
+        self._processed_count = 0
+        self._media_count = 0
+        self._warnings = collections.OrderedDict()
+
+    def _print(self, message, end='\n'):
+        print(message, end=end, file=self._file or sys.stdout)
+
+    def _print_progress(self):
+        progress = 'Processed tweets: {0}'.format(self._processed_count)
+        if self._media_count > 0:
+            progress += ', downloaded media: {0}'.format(self._media_count)
+        self._print(progress + '\r', end='')
+        self._last_progress = time.monotonic()
+
+    def info(self, message):
+        self._print(message)
+
+    def warning(self, message):
+        if message not in self._warnings:
+            self._warnings[message] = 0
+            self._print('Warning: {0}'.format(message))
+        self._warnings[message] += 1
+
+    def error(self, message):
+        self._print(message)
+
+    def crawl_started(self, conversation_id):
+        self._processed_count = 0
+        self._media_count = 0
+        self._warnings.clear()
+        self._last_progress = 0
+
+    def message_parsed(self, conversation_id, message, processed_count):
+        self._processed_count = processed_count
+        if time.monotonic() - self._last_progress >= self._interval:
+            self._print_progress()
+
+    def media_completed(self, conversation_id, url, path, size):
+        self._media_count += 1
+
+    def crawl_finished(self, conversation_id, processed_count):
+        total = 'Total processed tweets: {0}'.format(processed_count)
+        if self._media_count > 0:
+            total += ', downloaded media: {0}'.format(self._media_count)
+        self._print(total)
+        for message, count in self._warnings.items():
+            if count > 1:
+                self._print('Warning: {0} ({1} times)'.format(message, count))
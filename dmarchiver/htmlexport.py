@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - HTML export
+
+    Renders the parsed messages of a conversation as a set of static
+    pages, one per month, in the '<conversation_id>/html' folder.
+    The messages of each month are kept next to the pages so that an
+    incremental crawl only regenerates the months it has touched.
+
+    Usage:
+
+    >>> from dmarchiver.htmlexport import HtmlExporter
+    >>> HtmlExporter('conversation_id').export(conversation.tweets.values())
+
+    The pages of a conversation archived before can be rendered from its
+    text archive:
+
+    >>> with ArchiveReader('conversation_id.txt') as reader:
+    ...     HtmlExporter('conversation_id').import_archive(reader)
+"""
+
+import datetime
+import html
+import json
+import os
+import re
+import shutil
+
+from .reader import ArchivedMessage, _TWITTER_EPOCH
+
+__all__ = ['HtmlExporter']
+
+# Elements of a message line of a text archive, as written by their __str__
+_ARCHIVE_ELEMENT_RE = re.compile(
+    r'\[Media-(\w+)\] (?:\[(.*?)\] )?(\S+)(?: \[Media-preview\] (\S+))?'
+    r'|\[Tweet\] (\S+)'
+    r'|\[Card-([^\]]*)\] (\S+)')
+
+# Folder of the downloaded files of each media type
+_MEDIA_FOLDERS = {'image': 'images', 'sticker': 'images',
+                  'gif': 'mp4-gifs', 'video': 'mp4-videos'}
+
+_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 50em; margin: auto; }}
+.message {{ margin: 0.5em 0; }}
+.date {{ color: #888; font-size: 0.8em; }}
+.author {{ font-weight: bold; }}
+.entry {{ color: #888; font-style: italic; }}
+img, video {{ display: block; max-width: 100%; max-height: 30em; }}
+nav {{ margin: 1em 0; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{navigation}
+{content}
+{navigation}
+</body>
+</html>
+'''
+
+
+def _month_of(record):
+    """Return the 'YYYY-MM' key of a serialized message"""
+
+    if 'time_stamp' in record:
+        time_stamp = int(record['time_stamp'])
+    else:
+        # DMConversationEntry items have no timestamp, use the tweet ID
+        time_stamp = ((int(record['tweet_id']) >> 22) + _TWITTER_EPOCH) // 1000
+    return datetime.datetime.fromtimestamp(time_stamp).strftime('%Y-%m')
+
+
+def _media_filename(media_type, url, media_files):
+    """Return the downloaded file of an archived media, or ''"""
+
+    folder = _MEDIA_FOLDERS.get(media_type)
+    filename = media_files.get((folder, url))
+    if filename is None and media_type == 'video':
+        # Videos are archived with their page URL, which ends with the
+        # tweet ID, and downloaded from another URL
+        filename = media_files.get((folder, url.rsplit('/', 1)[-1]))
+    return filename or ''
+
+
+def _elements_from_text(text, media_files):
+    """Return the serialized elements of the text of an archived message"""
+
+    elements = []
+    position = 0
+    for match in _ARCHIVE_ELEMENT_RE.finditer(text):
+        if text[position:match.start()].strip() != '':
+            elements.append({'type': 'text', 'text': text[position:match.start()].strip(' ')})
+        position = match.end()
+        if match.group(1) is not None:
+            elements.append({'type': 'media',
+                             'media_type': match.group(1),
+                             'url': match.group(3),
+                             'preview_url': match.group(4) or '',
+                             'alt': match.group(2) or '',
+                             'filename': _media_filename(match.group(1), match.group(3), media_files)})
+        elif match.group(5) is not None:
+            elements.append({'type': 'tweet', 'url': match.group(5)})
+        else:
+            elements.append({'type': 'card',
+                             'url': match.group(7),
+                             'name': match.group(6),
+                             'expanded_url': match.group(7)})
+    if text[position:].strip() != '':
+        elements.append({'type': 'text', 'text': text[position:].strip(' ')})
+    return elements
+
+
+def _records_from_archive(records, media):
+    """Yield the serialized messages of the records of a text archive.
+
+    The archive does not keep the tweet IDs, so each message gets an ID
+    built from its date like a Twitter ID, which keeps the messages of
+    the archive and of the next crawls in chronological order.
+    """
+
+    # The manifest gives the downloaded files by folder and URL or tweet ID
+    media_files = {}
+    for path, entry in media.items():
+        folder, filename = path.split('/', 1)
+        media_files[(folder, entry['url'])] = filename
+        media_files[(folder, entry['tweet_id'])] = filename
+    time_stamp = None
+    sequence = 0
+    for record in records:
+        if isinstance(record, ArchivedMessage):
+            record_time_stamp = int(record.time_stamp)
+            sequence = sequence + 1 if record_time_stamp == time_stamp else 0
+            time_stamp = record_time_stamp
+        elif time_stamp is None:
+            # Entry before the first message of the archive
+            continue
+        else:
+            sequence += 1
+        tweet_id = str(((time_stamp * 1000 - _TWITTER_EPOCH) << 22) + sequence)
+
+        if isinstance(record, ArchivedMessage):
+            yield {'type': 'DirectMessage',
+                   'tweet_id': tweet_id,
+                   'time_stamp': str(time_stamp),
+                   'author': record.author,
+                   'elements': _elements_from_text(record.text, media_files)}
+        else:
+            yield {'type': 'DMConversationEntry',
+                   'tweet_id': tweet_id,
+                   'text': record.text}
+
+
+class HtmlExporter(object):
+    """This class writes and incrementally updates the HTML pages
+    of a conversation.
+    """
+
+    def __init__(self, conversation_id, output_dir=None):
+        self._conversation_id = conversation_id
+        self._media_dir = conversation_id
+        if output_dir is None:
+            output_dir = os.path.join(conversation_id, 'html')
+        self._output_dir = output_dir
+        self._data_dir = os.path.join(output_dir, 'data')
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self._data_dir, 'index.json'))
+
+    def clear(self):
+        """Remove the pages and their data"""
+
+        shutil.rmtree(self._output_dir, ignore_errors=True)
+
+    def export(self, messages):
+        """Merge the messages into the archive and regenerate the pages
+        of the months which received new messages.
+        """
+
+        return self._export(message.to_dict() for message in messages)
+
+    def import_archive(self, records, media=None):
+        """Merge the records of a text archive (e.g. an ArchiveReader) and
+        regenerate the pages. 'media' is the 'media' dictionary of the
+        manifest, used to display the downloaded files.
+        """
+
+        return self._export(_records_from_archive(records, media or {}))
+
+    def _export(self, records):
+        months = None
+        new_months = []
+        touched = set()
+
+        # The records are grouped by month as they come, so that an
+        # archive is merged one month at a time
+        month = None
+        updates = {}
+        for record in records:
+            record_month = _month_of(record)
+            if record_month != month and len(updates) > 0:
+                months = self._merge_month(month, updates, months, new_months)
+                touched.add(month)
+                updates = {}
+            month = record_month
+            updates[record['tweet_id']] = record
+        if len(updates) > 0:
+            months = self._merge_month(month, updates, months, new_months)
+            touched.add(month)
+
+        if len(touched) == 0:
+            return []
+
+        # A new month changes the navigation links of its neighbours
+        ordered_months = sorted(months)
+        for month in new_months:
+            position = ordered_months.index(month)
+            if position > 0:
+                touched.add(ordered_months[position - 1])
+            if position < len(ordered_months) - 1:
+                touched.add(ordered_months[position + 1])
+
+        for month in sorted(touched):
+            self._write_page(month, ordered_months)
+
+        self._save_index(months)
+        self._write_index(months)
+
+        return sorted(touched)
+
+    def _merge_month(self, month, updates, months, new_months):
+        if months is None:
+            os.makedirs(self._data_dir, exist_ok=True)
+            months = self._load_index()
+        if month not in months and month not in new_months:
+            new_months.append(month)
+        records = self._load_month(month)
+        records.update(updates)
+        self._save_month(month, records)
+        months[month] = len(records)
+        return months
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self._data_dir, 'index.json'), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self, months):
+        with open(os.path.join(self._data_dir, 'index.json'), 'w', encoding='utf-8') as file:
+            json.dump(months, file, sort_keys=True)
+
+    def _load_month(self, month):
+        try:
+            with open(os.path.join(self._data_dir, '{0}.json'.format(month)), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _save_month(self, month, records):
+        with open(os.path.join(self._data_dir, '{0}.json'.format(month)), 'w', encoding='utf-8') as file:
+            json.dump(records, file)
+
+    def _local_media(self, folder, filename):
+        """Return the relative path of a downloaded media, if any"""
+
+        if filename and os.path.isfile(os.path.join(self._media_dir, folder, filename)):
+            return '../{0}/{1}'.format(folder, filename)
+        return None
+
+    def _render_element(self, element):
+        element_type = element['type']
+        if element_type == 'text':
+            return '<span class="text">{0}</span>'.format(
+                html.escape(element['text']).replace('\n', '<br>'))
+        elif element_type == 'tweet':
+            return '<a class="tweet" href="{0}">[Tweet] {1}</a>'.format(
+                html.escape(element['url']), html.escape(element['url']))
+        elif element_type == 'card':
+            return '<a class="card" href="{0}">[Card-{1}] {2}</a>'.format(
+                html.escape(element['expanded_url']),
+                html.escape(element['name'] or ''),
+                html.escape(element['expanded_url']))
+        elif element_type == 'media':
+            media_type = element['media_type']
+            url = element['url'] or ''
+            alt = html.escape(element['alt'] or '')
+            if media_type == 'image':
+                source = self._local_media('images', element['filename']) or url
+                return '<a href="{0}"><img src="{0}" alt="{1}"></a>'.format(
+                    html.escape(source), alt)
+            elif media_type == 'sticker':
+                return '<img class="sticker" src="{0}" alt="{1}">'.format(
+                    html.escape(url), alt)
+            elif media_type == 'gif':
+                source = self._local_media('mp4-gifs', element['filename'])
+                if source is None:
+                    source = url
+                return '<video src="{0}" poster="{1}" autoplay loop muted playsinline></video>'.format(
+                    html.escape(source), html.escape(element['preview_url'] or ''))
+            elif media_type == 'video':
+                source = self._local_media('mp4-videos', element['filename'])
+                if source is None:
+                    return '<a href="{0}"><img src="{1}" alt="[Media-video]"></a>'.format(
+                        html.escape(url), html.escape(element['preview_url'] or ''))
+                return '<video src="{0}" poster="{1}" controls></video>'.format(
+                    html.escape(source), html.escape(element['preview_url'] or ''))
+            return '<a class="media" href="{0}">[Media-{1}]</a>'.format(
+                html.escape(url), html.escape(media_type))
+        return ''
+
+    def _render_record(self, record):
+        if record['type'] == 'DMConversationEntry':
+            return '<div class="entry" id="{0}">{1}</div>'.format(
+                record['tweet_id'], html.escape(record['text']))
+
+        formatted_date = datetime.datetime.fromtimestamp(
+            int(record['time_stamp'])).strftime('%Y-%m-%d %H:%M:%S')
+        elements = ' '.join(self._render_element(element)
+                            for element in record['elements'])
+        return '<div class="message" id="{0}"><span class="date">[{1}]</span> <span class="author">&lt;{2}&gt;</span> {3}</div>'.format(
+            record['tweet_id'], formatted_date, html.escape(record['author']), elements)
+
+    def _write_page(self, month, ordered_months):
+        records = self._load_month(month)
+        ordered_records = sorted(records.values(), key=lambda record: int(record['tweet_id']))
+
+        position = ordered_months.index(month)
+        links = ['<a href="index.html">Index</a>']
+        if position > 0:
+            links.insert(0, '<a href="{0}.html">&larr; {0}</a>'.format(
+                ordered_months[position - 1]))
+        if position < len(ordered_months) - 1:
+            links.append('<a href="{0}.html">{0} &rarr;</a>'.format(
+                ordered_months[position + 1]))
+
+        page = _PAGE_TEMPLATE.format(
+            title='{0} - {1}'.format(html.escape(self._conversation_id), month),
+            navigation='<nav>{0}</nav>'.format(' | '.join(links)),
+            content='\n'.join(self._render_record(record) for record in ordered_records))
+
+        with open(os.path.join(self._output_dir, '{0}.html'.format(month)), 'w', encoding='utf-8') as file:
+            file.write(page)
+
+    def _write_index(self, months):
+        content = '<ul>\n{0}\n</ul>'.format('\n'.join(
+            '<li><a href="{0}.html">{0}</a> ({1} messages)</li>'.format(month, months[month])
+            for month in sorted(months, reverse=True)))
+        page = _PAGE_TEMPLATE.format(
+            title=html.escape(self._conversation_id),
+            navigation='',
+            content=content)
+
+        with open(os.path.join(self._output_dir, 'index.html'), 'w', encoding='utf-8') as file:
+            file.write(page)
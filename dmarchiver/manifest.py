@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Manifest
+
+    Keeps track of what a crawl has written for a conversation: the
+    latest tweet ID and the number of messages of the text archive,
+    and the expected size and SHA-256 of every downloaded media.
+    The manifest is stored in '<conversation_id>/manifest.json'.
+"""
+
+import json
+import os
+
+__all__ = ['Manifest']
+
+
+class Manifest(object):
+    """This class is a representation of the manifest of a conversation"""
+
+    def __init__(self, conversation_id, filename=None):
+        self.conversation_id = conversation_id
+        if filename is None:
+            filename = os.path.join(conversation_id, 'manifest.json')
+        self.filename = filename
+        self.latest_tweet_id = None
+        self.message_count = 0
+        self.media = {}
+
+    @classmethod
+    def load(cls, conversation_id, filename=None):
+        """Return the manifest of the conversation, empty if not found"""
+
+        manifest = cls(conversation_id, filename)
+        try:
+            with open(manifest.filename, 'r', encoding='utf-8') as file:
+                content = json.load(file)
+        except FileNotFoundError:
+            return manifest
+
+        manifest.latest_tweet_id = content.get('latest_tweet_id')
+        manifest.message_count = content.get('message_count', 0)
+        manifest.media = content.get('media', {})
+        return manifest
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def add_media(self, path, tweet_id, url, size, sha256):
+        """Record a downloaded media.
+
+        'path' is relative to the conversation folder, e.g. 'images/xxx.jpg'.
+        'sha256' is None when the download ended before the expected size.
+        """
+
+        self.media[path] = {'tweet_id': tweet_id,
+                            'url': url,
+                            'size': size,
+                            'sha256': sha256}
+
+    def set_archive(self, latest_tweet_id, message_count):
+        self.latest_tweet_id = latest_tweet_id
+        self.message_count = message_count
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first to never leave a partial manifest
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf-8') as file:
+            json.dump({'conversation_id': self.conversation_id,
+                       'latest_tweet_id': self.latest_tweet_id,
+                       'message_count': self.message_count,
+                       'media': self.media}, file, indent=1, sort_keys=True)
+        os.replace(temporary_filename, self.filename)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Parse cache
+
+    The HTML of a message never changes once it is sent. This module keeps
+    the parsed messages in a SQLite database, keyed by tweet ID and by a
+    digest of their HTML, so that they are not parsed (and their cards
+    not expanded) again on the next crawls. The least recently used
+    messages are evicted when the cache exceeds its maximum size.
+
+    Usage:
+
+    >>> from dmarchiver.core import Crawler
+    >>> from dmarchiver.parsecache import ParseCache
+    >>> crawler = Crawler(parse_cache=ParseCache('dmarchiver_cache.db'))
+"""
+
+import hashlib
+import json
+import sqlite3
+
+__all__ = ['ParseCache']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    tweet_id TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    record TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (tweet_id, digest)
+);
+CREATE INDEX IF NOT EXISTS messages_last_used ON messages (last_used);
+'''
+
+
+class ParseCache(object):
+    """This class is a persistent LRU cache of the parsed messages"""
+
+    def __init__(self, filename, max_size=512 * 1024 * 1024):
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(filename)
+        self._connection.executescript(_SCHEMA)
+        self._size, self._clock = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM messages').fetchone()
+
+    @staticmethod
+    def _digest(html):
+        return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+    def _tick(self):
+        # A counter rather than the time to keep the order of the accesses
+        self._clock += 1
+        return self._clock
+
+    def get(self, tweet_id, html):
+        """Return the serialized message parsed from this HTML, or None"""
+
+        digest = self._digest(html)
+        row = self._connection.execute(
+            'SELECT record FROM messages WHERE tweet_id = ? AND digest = ?',
+            (tweet_id, digest)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._connection.execute(
+            'UPDATE messages SET last_used = ? WHERE tweet_id = ? AND digest = ?',
+            (self._tick(), tweet_id, digest))
+        return json.loads(row[0])
+
+    def put(self, tweet_id, html, record):
+        """Store the serialized message parsed from this HTML"""
+
+        digest = self._digest(html)
+        content = json.dumps(record)
+        size = len(tweet_id) + len(digest) + len(content)
+        previous = self._connection.execute(
+            'SELECT size FROM messages WHERE tweet_id = ? AND digest = ?',
+            (tweet_id, digest)).fetchone()
+        if previous is not None:
+            self._size -= previous[0]
+
+        self._connection.execute(
+            'INSERT OR REPLACE INTO messages (tweet_id, digest, record, size, last_used) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (tweet_id, digest, content, size, self._tick()))
+        self._size += size
+
+        if self._size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used messages to free a tenth of the cache"""
+
+        target = self.max_size * 9 // 10
+        rows = self._connection.execute(
+            'SELECT rowid, size FROM messages ORDER BY last_used')
+        evicted = []
+        for rowid, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((rowid,))
+            self._size -= size
+        self._connection.executemany(
+            'DELETE FROM messages WHERE rowid = ?', evicted)
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Archive reader
+
+    Reads back the '<conversation_id>.txt' files written by the crawler.
+    The file is memory-mapped and its records are parsed lazily, so even
+    very large archives are not loaded in memory. A sparse index of the
+    offsets of the messages is built on the first seek, to jump to a date
+    or to a tweet ID.
+
+    Usage:
+
+    >>> from dmarchiver.reader import ArchiveReader
+    >>> with ArchiveReader('conversation_id.txt') as reader:
+    ...     for record in reader.seek_date(datetime.datetime(2017, 1, 1)):
+    ...         print(record.author, record.text)
+"""
+
+import bisect
+import collections
+import datetime
+import mmap
+import os
+import re
+import time
+
+__all__ = ['ArchiveReader', 'ArchivedMessage', 'ArchivedEntry', 'find_trailer']
+
+# Twitter IDs embed their creation time (in ms) since this epoch
+_TWITTER_EPOCH = 1288834974657
+
+_MESSAGE_RE = re.compile(rb'^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] <(.*?)> ?')
+_ENTRY_PREFIX = b'[DMConversationEntry] '
+_TRAILER_RE = re.compile(rb'^\[LatestTweetID\] ([0-9]+)\s*$')
+
+
+class ArchivedMessage(collections.namedtuple(
+        'ArchivedMessage', ['date', 'author', 'text', 'offset'])):
+    """A message of an archive. 'date' is its local date as written
+    in the archive ('YYYY-MM-DD HH:MM:SS').
+    """
+
+    __slots__ = ()
+
+    @property
+    def time_stamp(self):
+        """The date as a Unix timestamp, like DirectMessage.time_stamp"""
+
+        return str(int(time.mktime(time.strptime(self.date, '%Y-%m-%d %H:%M:%S'))))
+
+
+ArchivedEntry = collections.namedtuple('ArchivedEntry', ['text', 'offset'])
+
+
+def find_trailer(filename, block_size=4096):
+    """Return the offset and the tweet ID of the [LatestTweetID] line
+    ending the archive, or None. Only the end of the file is read.
+    """
+
+    with open(filename, 'rb') as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        tail = b''
+        while position > 0:
+            position = max(0, position - block_size)
+            file.seek(position)
+            tail = file.read(end - position)
+            # The last line is complete once a line break precedes it
+            if tail.rstrip().rfind(b'\n') >= 0:
+                break
+
+    stripped = tail.rstrip()
+    line_start = stripped.rfind(b'\n') + 1
+    result = _TRAILER_RE.match(stripped[line_start:])
+    if result is None:
+        return None
+    return position + line_start, result.group(1).decode('ascii')
+
+
+def _date_key(value):
+    """Return the archive date string of a datetime or a Unix timestamp"""
+
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.fromtimestamp(value)
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ArchiveReader(object):
+    """This class is a lazy reader of a text archive"""
+
+    def __init__(self, filename, index_interval=1000):
+        self.filename = filename
+        self._index_interval = index_interval
+        self._index_dates = None
+        self._index_offsets = None
+        self._file = open(filename, 'rb')
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files cannot be memory-mapped
+            self._data = b''
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def _lines(self, offset):
+        """Yield the offset and the content of the lines from an offset"""
+
+        data = self._data
+        size = len(data)
+        while offset < size:
+            end = data.find(b'\n', offset)
+            if end < 0:
+                end = size
+            yield offset, data[offset:end].rstrip(b'\r')
+            offset = end + 1
+
+    def records(self, offset=0):
+        """Yield the messages and the entries of the archive from an offset
+        (which must be the start of a record)
+        """
+
+        current = None
+        lines = []
+        for line_offset, line in self._lines(offset):
+            result = _MESSAGE_RE.match(line)
+            if result is not None or line.startswith(_ENTRY_PREFIX) or _TRAILER_RE.match(line):
+                if current is not None:
+                    record = self._make_record(current, lines)
+                    if record is not None:
+                        yield record
+                current = (line_offset, result)
+                lines = [line]
+            elif current is not None:
+                # Next line of a message written on several lines
+                lines.append(line)
+
+        if current is not None:
+            record = self._make_record(current, lines)
+            if record is not None:
+                yield record
+
+    def _make_record(self, current, lines):
+        offset, result = current
+        text = b'\n'.join(lines)
+        if result is None:
+            if text.startswith(_ENTRY_PREFIX):
+                return ArchivedEntry(text[len(_ENTRY_PREFIX):].decode('utf-8'), offset)
+            # [LatestTweetID] trailer
+            return None
+
+        return ArchivedMessage(
+            result.group(1).decode('ascii'),
+            result.group(2).decode('utf-8'),
+            text[result.end():].decode('utf-8'),
+            offset)
+
+    def messages(self, offset=0):
+        """Yield only the messages, without the entries"""
+
+        for record in self.records(offset):
+            if isinstance(record, ArchivedMessage):
+                yield record
+
+    def _build_index(self):
+        """Index the date and the offset of one message every 'index_interval'"""
+
+        self._index_dates = []
+        self._index_offsets = []
+        counter = 0
+        for line_offset, line in self._lines(0):
+            result = _MESSAGE_RE.match(line)
+            if result is None:
+                continue
+            if counter % self._index_interval == 0:
+                self._index_dates.append(result.group(1).decode('ascii'))
+                self._index_offsets.append(line_offset)
+            counter += 1
+
+    def seek_date(self, value):
+        """Yield the records from the first message sent at or after a date
+        (a datetime or a Unix timestamp)
+        """
+
+        if self._index_dates is None:
+            self._build_index()
+
+        date = _date_key(value)
+        # Archive dates are ordered and their format sorts chronologically
+        position = bisect.bisect_left(self._index_dates, date) - 1
+        offset = self._index_offsets[position] if position >= 0 else 0
+
+        started = False
+        for record in self.records(offset):
+            if not started:
+                if not isinstance(record, ArchivedMessage) or record.date < date:
+                    continue
+                started = True
+            yield record
+
+    def seek_tweet_id(self, tweet_id):
+        """Yield the records from the date of a tweet ID.
+
+        The archive does not contain the IDs but they embed their creation
+        time, so the first record is the first message of the same second.
+        """
+
+        time_stamp = ((int(tweet_id) >> 22) + _TWITTER_EPOCH) // 1000
+        return self.seek_date(time_stamp)
+
+    def latest_tweet_id(self):
+        trailer = find_trailer(self.filename)
+        return trailer[1] if trailer is not None else None
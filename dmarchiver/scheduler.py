@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Scheduler
+
+    Orders the conversations to crawl by priority and selects the ones
+    which fit in the request or time budget of a run. The number of
+    requests of the previous crawls of each conversation is kept in
+    'dmarchiver_schedule.json' to estimate the remaining work.
+
+    Usage:
+
+    >>> from dmarchiver.scheduler import Scheduler
+    >>> scheduler = Scheduler(priority='new')
+    >>> for thread_id in scheduler.plan(threads, request_budget=500):
+    ...     result = crawler.crawl(thread_id)
+    ...     scheduler.record(thread_id, result, elapsed)
+    >>> scheduler.save()
+"""
+
+import json
+import os
+import time
+
+from .shards import archive_exists
+
+__all__ = ['Scheduler', 'PRIORITIES']
+
+PRIORITIES = ['recent', 'new', 'weight']
+
+# Estimated requests when a conversation has no history
+_DEFAULT_FULL_CRAWL_REQUESTS = 50
+_DEFAULT_INCREMENTAL_REQUESTS = 2
+
+
+class Scheduler(object):
+    """This class orders the conversations and plans a budgeted run.
+
+    Priorities:
+    - 'recent': most recently active first (the order of the inbox)
+    - 'new': never archived or unfinished conversations first
+    - 'weight': highest user-supplied weight first (default weight: 1)
+    Ties are broken by the order of the inbox.
+    """
+
+    def __init__(self, priority='recent', weights=None, filename='dmarchiver_schedule.json'):
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority \'{0}\''.format(priority))
+        self._priority = priority
+        self._weights = weights or {}
+        self._filename = filename
+        try:
+            with open(filename, 'r', encoding='utf-8') as file:
+                self._state = json.load(file)
+        except FileNotFoundError:
+            self._state = {'seconds_per_request': None, 'threads': {}}
+
+    def save(self):
+        with open(self._filename, 'w', encoding='utf-8') as file:
+            json.dump(self._state, file, indent=1, sort_keys=True)
+
+    @staticmethod
+    def is_archived(thread_id):
+        """Return True if a complete archive of the thread exists"""
+
+        return archive_exists(thread_id) and \
+            not os.path.isfile('{0}.checkpoint'.format(thread_id))
+
+    def estimate_requests(self, thread_id):
+        """Return the estimated number of requests to update a thread"""
+
+        history = self._state['threads'].get(thread_id, {})
+        if self.is_archived(thread_id):
+            return history.get('incremental_requests', _DEFAULT_INCREMENTAL_REQUESTS)
+
+        # Full crawl, possibly already started by previous runs
+        estimate = history.get('full_requests', _DEFAULT_FULL_CRAWL_REQUESTS)
+        return max(1, estimate - history.get('pending_requests', 0))
+
+    def order(self, threads):
+        """Return the threads sorted by priority"""
+
+        positions = {thread_id: position for position, thread_id in enumerate(threads)}
+        if self._priority == 'new':
+            def key(thread_id):
+                return (self.is_archived(thread_id), positions[thread_id])
+        elif self._priority == 'weight':
+            def key(thread_id):
+                return (-float(self._weights.get(thread_id, 1)), positions[thread_id])
+        else:
+            def key(thread_id):
+                return positions[thread_id]
+        return sorted(threads, key=key)
+
+    def plan(self, threads, request_budget=None, time_budget=None):
+        """Return the threads to crawl in this run, by priority.
+
+        Threads whose estimated work does not fit in the remaining budget
+        are left for the next run, except the first one of them which is
+        planned last to use what remains (its crawl will continue on the
+        next run).
+        """
+
+        ordered_threads = self.order(threads)
+        budget = request_budget
+        if time_budget is not None and self._state['seconds_per_request']:
+            time_requests = int(time_budget / self._state['seconds_per_request'])
+            budget = time_requests if budget is None else min(budget, time_requests)
+        if budget is None:
+            return ordered_threads
+
+        planned = []
+        partial_thread = None
+        for thread_id in ordered_threads:
+            estimate = self.estimate_requests(thread_id)
+            if estimate <= budget:
+                planned.append(thread_id)
+                budget -= estimate
+            elif partial_thread is None:
+                partial_thread = thread_id
+
+        if partial_thread is not None and budget > 0:
+            planned.append(partial_thread)
+        return planned
+
+    def record(self, thread_id, result, elapsed):
+        """Update the history of a thread with the result of its crawl"""
+
+        history = self._state['threads'].setdefault(thread_id, {})
+        history['last_crawl'] = int(time.time())
+
+        requests = history.get('pending_requests', 0) + result.requests
+        if not result.complete:
+            history['pending_requests'] = requests
+        elif result.incremental:
+            # Moving average of the incremental updates
+            previous = history.get('incremental_requests', requests)
+            history['incremental_requests'] = round((previous + requests) / 2, 1)
+            history['pending_requests'] = 0
+        else:
+            history['full_requests'] = requests
+            history['pending_requests'] = 0
+
+        if result.requests > 0:
+            seconds_per_request = elapsed / result.requests
+            previous = self._state['seconds_per_request'] or seconds_per_request
+            self._state['seconds_per_request'] = (previous + seconds_per_request) / 2
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Sharded archives
+
+    Splits the text archive of a conversation into several files, one per
+    month or one per N records (messages and entries), in the
+    '<conversation_id>/shards' folder. The lines have the same format as
+    in '<conversation_id>.txt'. The 'index.json' file of the folder keeps
+    the date range, the number of records and the size of each shard,
+    and the latest tweet ID of the archive.
+
+    An incremental update only appends to the newest shards, and the
+    shards can be read or verified independently.
+
+    Usage:
+
+    >>> from dmarchiver.shards import ShardedArchive
+    >>> archive = ShardedArchive('conversation_id')
+    >>> for record in archive.records():
+    ...     print(record)
+"""
+
+import json
+import os
+
+from .reader import ArchiveReader, ArchivedMessage, _date_key
+
+__all__ = ['ShardedArchive', 'parse_shard_mode', 'archive_exists']
+
+
+def _index_path(conversation_id, directory='.'):
+    return os.path.join(directory, conversation_id, 'shards', 'index.json')
+
+
+def archive_exists(conversation_id, directory='.'):
+    """Return True if the conversation has a text or a sharded archive"""
+
+    return os.path.isfile(os.path.join(directory, '{0}.txt'.format(conversation_id))) or \
+        os.path.isfile(_index_path(conversation_id, directory))
+
+
+def parse_shard_mode(value):
+    """Return 'month' or a number of records per shard"""
+
+    if value == 'month':
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        raise ValueError('Invalid shard mode \'{0}\', expected \'month\' or a number of records'.format(value))
+    if size <= 0:
+        raise ValueError('The number of records per shard must be positive')
+    return size
+
+
+class ShardedArchive(object):
+    """This class is a representation of the shards of a conversation"""
+
+    def __init__(self, conversation_id, mode='month', directory=None):
+        self.conversation_id = conversation_id
+        if directory is None:
+            self._index_filename = _index_path(conversation_id)
+            directory = os.path.dirname(self._index_filename)
+        else:
+            self._index_filename = os.path.join(directory, 'index.json')
+        self.directory = directory
+        try:
+            with open(self._index_filename, 'r', encoding='utf-8') as file:
+                index = json.load(file)
+        except FileNotFoundError:
+            index = {'mode': mode, 'latest_tweet_id': None, 'shards': []}
+        # The mode of an existing archive cannot be changed
+        self.mode = index['mode']
+        self.latest_tweet_id = index['latest_tweet_id']
+        self.shards = index['shards']
+
+    def exists(self):
+        return os.path.isfile(self._index_filename)
+
+    def _save_index(self):
+        temporary_filename = self._index_filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf-8') as file:
+            json.dump({'mode': self.mode,
+                       'latest_tweet_id': self.latest_tweet_id,
+                       'shards': self.shards}, file, indent=1)
+        os.replace(temporary_filename, self._index_filename)
+
+    def _shard_name(self, date):
+        if self.mode == 'month':
+            return '{0}.txt'.format(date[:7])
+        return '{0:06d}.txt'.format(len(self.shards))
+
+    def _recover(self):
+        """Drop the lines appended after the last saved index, e.g. by a
+        crawl interrupted before the index was saved
+        """
+
+        for shard, path in zip(self.shards, self.paths()):
+            try:
+                if os.path.getsize(path) > shard['size']:
+                    with open(path, 'rb+') as file:
+                        file.truncate(shard['size'])
+            except FileNotFoundError:
+                pass
+
+    def append(self, items, latest_tweet_id):
+        """Append the (date, line) items, from the oldest to the newest.
+
+        The lines of the DMConversationEntry items (without date) go to
+        the shard of the previous message. The items are written as they
+        come and the index is saved at the end with the new size of each
+        shard, so the lines of an interrupted append are dropped by the
+        next one.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        shard = self.shards[-1] if len(self.shards) > 0 else None
+        file = None
+
+        try:
+            for date, line in items:
+                new_shard = None
+                if date is not None:
+                    if shard is None or \
+                            (self.mode == 'month' and self._shard_name(date) != shard['file']) or \
+                            (self.mode != 'month' and shard['records'] >= self.mode):
+                        new_shard = {'file': self._shard_name(date),
+                                     'first': date,
+                                     'last': date,
+                                     'records': 0,
+                                     'size': 0}
+                elif shard is None:
+                    # Entry before the first message of the archive
+                    new_shard = {'file': self._shard_name('0000-00'),
+                                 'first': None,
+                                 'last': None,
+                                 'records': 0,
+                                 'size': 0}
+
+                if new_shard is not None:
+                    if file is not None:
+                        shard['size'] = file.tell()
+                        file.close()
+                    shard = new_shard
+                    self.shards.append(shard)
+                    # The file may remain from an interrupted append
+                    file = open(os.path.join(self.directory, shard['file']), 'wb')
+                elif file is None:
+                    file = open(os.path.join(self.directory, shard['file']), 'ab')
+
+                if date is not None:
+                    if shard['first'] is None:
+                        shard['first'] = date
+                    shard['last'] = date
+                shard['records'] += 1
+                file.write(line.encode('UTF-8'))
+
+            if file is not None:
+                shard['size'] = file.tell()
+        finally:
+            if file is not None:
+                file.close()
+
+        self.latest_tweet_id = latest_tweet_id
+        self._save_index()
+
+    @staticmethod
+    def _archive_items(reader):
+        for record in reader:
+            if isinstance(record, ArchivedMessage):
+                line = '[{0}] <{1}> {2}'.format(record.date, record.author, record.text)
+                yield record.date, line.replace('\n', os.linesep) + os.linesep
+            else:
+                yield None, '[DMConversationEntry] {0}{1}'.format(record.text, os.linesep)
+
+    def import_archive(self, filename):
+        """Split an existing text archive into shards, streaming its records"""
+
+        with ArchiveReader(filename) as reader:
+            self.append(self._archive_items(reader), reader.latest_tweet_id())
+
+    def paths(self):
+        """Return the paths of the shards, from the oldest to the newest"""
+
+        return [os.path.join(self.directory, shard['file']) for shard in self.shards]
+
+    def records(self):
+        """Yield the records of all the shards"""
+
+        for path in self.paths():
+            with ArchiveReader(path) as reader:
+                for record in reader:
+                    yield record
+
+    def seek_date(self, value):
+        """Yield the records from the first message sent at or after a date
+        (a datetime or a Unix timestamp), skipping the older shards
+        """
+
+        date = _date_key(value)
+        started = False
+        for shard, path in zip(self.shards, self.paths()):
+            if shard['last'] is not None and shard['last'] < date:
+                continue
+            with ArchiveReader(path) as reader:
+                records = reader if started else reader.seek_date(value)
+                for record in records:
+                    started = True
+                    yield record
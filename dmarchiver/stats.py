@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Statistics
+
+    Loads the author, the date and the media of the messages of the text
+    archives into NumPy arrays and computes the statistics of one or
+    several conversations: messages per author, per day and per hour,
+    media counts and response latencies.
+
+    The arrays of each conversation are cached in '<conversation_id>/stats'
+    and memory-mapped on the next runs, as long as the archive (or its
+    shards) is unchanged.
+
+    This module requires NumPy ('pip install dmarchiver[stats]').
+
+    Usage:
+
+    >>> from dmarchiver.stats import load_conversation, compute_statistics
+    >>> statistics = compute_statistics([load_conversation('conversation_id')])
+"""
+
+import collections
+import json
+import os
+import re
+
+import numpy as np
+
+from .reader import ArchiveReader
+from .shards import ShardedArchive
+
+__all__ = ['ConversationArrays', 'load_conversation', 'compute_statistics',
+           'ELEMENT_TYPES']
+
+# Columns of the element count matrix
+ELEMENT_TYPES = ['image', 'gif', 'video', 'sticker', 'tweet', 'card']
+
+_ELEMENT_RE = re.compile(r'\[(?:Media-(image|gif|video|sticker)|(Tweet)|(Card)-[^\]]*)\]')
+_ELEMENT_COLUMNS = {name: column for column, name in enumerate(ELEMENT_TYPES)}
+_ELEMENT_COLUMNS['Tweet'] = _ELEMENT_COLUMNS['tweet']
+_ELEMENT_COLUMNS['Card'] = _ELEMENT_COLUMNS['card']
+
+# Local time of the messages in seconds, as written in the archive
+ConversationArrays = collections.namedtuple(
+    'ConversationArrays', ['conversation_id', 'time_stamps', 'authors', 'author_names', 'elements'])
+
+
+def _count_elements(text, counts):
+    for match in _ELEMENT_RE.finditer(text):
+        name = match.group(1) or match.group(2) or match.group(3)
+        counts[_ELEMENT_COLUMNS[name]] += 1
+
+
+def _parse_archive(filenames):
+    """Read the messages of a text archive (or of its shards) into arrays"""
+
+    dates = []
+    authors = []
+    elements = []
+    author_codes = {}
+
+    for filename in filenames:
+        with ArchiveReader(filename) as reader:
+            for message in reader.messages():
+                dates.append(message.date.replace(' ', 'T'))
+                authors.append(author_codes.setdefault(message.author, len(author_codes)))
+                counts = [0] * len(ELEMENT_TYPES)
+                _count_elements(message.text, counts)
+                elements.append(counts)
+
+    time_stamps = np.array(dates, dtype='datetime64[s]').astype(np.int64)
+    author_names = sorted(author_codes, key=author_codes.get)
+    return (time_stamps,
+            np.array(authors, dtype=np.int32),
+            author_names,
+            np.array(elements, dtype=np.int32).reshape(-1, len(ELEMENT_TYPES)))
+
+
+def load_conversation(conversation_id, use_cache=True):
+    """Return the arrays of a conversation, from the cache if it is up to date"""
+
+    sharded_archive = ShardedArchive(conversation_id)
+    if sharded_archive.exists():
+        filenames = sharded_archive.paths()
+    else:
+        filenames = ['{0}.txt'.format(conversation_id)]
+    cache_dir = os.path.join(conversation_id, 'stats')
+    source = []
+    for filename in filenames:
+        status = os.stat(filename)
+        source.append({'file': filename, 'size': status.st_size, 'mtime': status.st_mtime})
+
+    if use_cache:
+        try:
+            with open(os.path.join(cache_dir, 'source.json'), 'r', encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached['source'] == source:
+                return ConversationArrays(
+                    conversation_id,
+                    np.load(os.path.join(cache_dir, 'time_stamps.npy'), mmap_mode='r'),
+                    np.load(os.path.join(cache_dir, 'authors.npy'), mmap_mode='r'),
+                    cached['author_names'],
+                    np.load(os.path.join(cache_dir, 'elements.npy'), mmap_mode='r'))
+        except (OSError, ValueError, KeyError):
+            pass
+
+    time_stamps, authors, author_names, elements = _parse_archive(filenames)
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(os.path.join(cache_dir, 'time_stamps.npy'), time_stamps)
+        np.save(os.path.join(cache_dir, 'authors.npy'), authors)
+        np.save(os.path.join(cache_dir, 'elements.npy'), elements)
+        # Written last, the cache is only valid once the arrays are complete
+        with open(os.path.join(cache_dir, 'source.json'), 'w', encoding='utf-8') as file:
+            json.dump({'source': source, 'author_names': author_names}, file)
+
+    return ConversationArrays(conversation_id, time_stamps, authors, author_names, elements)
+
+
+def _latencies(conversation):
+    """Return the delays between the messages which changed of author"""
+
+    order = np.argsort(conversation.time_stamps, kind='stable')
+    time_stamps = np.asarray(conversation.time_stamps)[order]
+    authors = np.asarray(conversation.authors)[order]
+    replies = authors[1:] != authors[:-1]
+    return np.diff(time_stamps)[replies]
+
+
+def compute_statistics(conversations):
+    """Return the statistics of a list of ConversationArrays as a dictionary"""
+
+    # Map the authors of every conversation to global codes
+    author_names = sorted(set(name for conversation in conversations
+                              for name in conversation.author_names))
+    global_codes = {name: code for code, name in enumerate(author_names)}
+
+    time_stamps = []
+    authors = []
+    elements = []
+    latencies = []
+    for conversation in conversations:
+        mapping = np.array([global_codes[name] for name in conversation.author_names] or [0],
+                           dtype=np.int32)
+        time_stamps.append(np.asarray(conversation.time_stamps))
+        authors.append(mapping[np.asarray(conversation.authors)])
+        elements.append(np.asarray(conversation.elements))
+        latencies.append(_latencies(conversation))
+
+    time_stamps = np.concatenate(time_stamps) if time_stamps else np.zeros(0, np.int64)
+    authors = np.concatenate(authors) if authors else np.zeros(0, np.int32)
+    elements = np.concatenate(elements) if elements else np.zeros((0, len(ELEMENT_TYPES)), np.int32)
+    latencies = np.concatenate(latencies) if latencies else np.zeros(0, np.int64)
+
+    per_author = np.bincount(authors, minlength=len(author_names))
+    days, per_day = np.unique(time_stamps // 86400, return_counts=True)
+    per_hour = np.bincount((time_stamps // 3600) % 24, minlength=24)
+    element_totals = elements.sum(axis=0)
+
+    statistics = {
+        'conversations': len(conversations),
+        'messages': int(time_stamps.size),
+        'first_message': None,
+        'last_message': None,
+        'messages_per_author': {name: int(count) for name, count in zip(author_names, per_author)},
+        'messages_per_day': {str(day): int(count) for day, count in
+                             zip((days * 86400).astype('datetime64[s]').astype('datetime64[D]'), per_day)},
+        'messages_per_hour': [int(count) for count in per_hour],
+        'elements': {name: int(count) for name, count in zip(ELEMENT_TYPES, element_totals)},
+        'response_latency': {'count': int(latencies.size)},
+    }
+
+    if time_stamps.size > 0:
+        statistics['first_message'] = str(time_stamps.min().astype('datetime64[s]'))
+        statistics['last_message'] = str(time_stamps.max().astype('datetime64[s]'))
+
+    if latencies.size > 0:
+        percentiles = np.percentile(latencies, [50, 90, 99])
+        bounds = [60, 600, 3600, 86400]
+        histogram = np.bincount(np.searchsorted(bounds, latencies, side='right'),
+                                minlength=len(bounds) + 1)
+        statistics['response_latency'].update({
+            'mean': float(latencies.mean()),
+            'median': float(percentiles[0]),
+            'p90': float(percentiles[1]),
+            'p99': float(percentiles[2]),
+            'histogram': {label: int(count) for label, count in
+                          zip(['<1m', '<10m', '<1h', '<1d', '>=1d'], histogram)},
+        })
+
+    return statistics
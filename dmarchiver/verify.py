@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Verification
+
+    Checks the text archives and the downloaded media of conversations
+    against their manifest and returns the list of what must be fetched
+    again. The checks are distributed over a pool of processes.
+
+    Usage:
+
+    >>> from dmarchiver.verify import verify
+    >>> problems = verify(['conversation_id'])
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import re
+
+from .manifest import Manifest
+from .reader import ArchiveReader, find_trailer
+from .shards import ShardedArchive, archive_exists
+
+__all__ = ['verify', 'find_conversations']
+
+
+def find_conversations(directory='.'):
+    """Return the IDs of the conversations archived in a directory"""
+
+    conversation_ids = set()
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path) and re.match(r'^[0-9-]+\.txt$', filename):
+            conversation_ids.add(filename[:-4])
+        elif os.path.isfile(os.path.join(path, 'manifest.json')) or \
+                archive_exists(filename, directory):
+            conversation_ids.add(filename)
+    return sorted(conversation_ids)
+
+
+def _problem(conversation_id, kind, problem, path, tweet_id=None, url=None):
+    return {'conversation_id': conversation_id,
+            'kind': kind,
+            'problem': problem,
+            'path': path,
+            'tweet_id': tweet_id,
+            'url': url}
+
+
+def _check_archive(conversation_id, latest_tweet_id, message_count):
+    """Check the trailer and the message count of a text archive"""
+
+    filename = '{0}.txt'.format(conversation_id)
+    if not os.path.isfile(filename):
+        return [_problem(conversation_id, 'archive', 'missing', filename,
+                         latest_tweet_id)]
+
+    trailer = find_trailer(filename)
+    if trailer is None:
+        return [_problem(conversation_id, 'archive', 'no_trailer', filename,
+                         latest_tweet_id)]
+
+    problems = []
+    found_tweet_id = trailer[1]
+    if latest_tweet_id is not None and found_tweet_id != latest_tweet_id:
+        problems.append(_problem(conversation_id, 'archive', 'trailer_mismatch',
+                                 filename, latest_tweet_id))
+    if message_count is not None:
+        with ArchiveReader(filename) as reader:
+            counted_messages = sum(1 for record in reader)
+    if message_count is not None and counted_messages < message_count:
+        problems.append(_problem(conversation_id, 'archive', 'missing_messages',
+                                 filename, latest_tweet_id))
+    return problems
+
+
+def _check_shard_index(conversation_id, sharded_archive, latest_tweet_id, message_count):
+    """Check the shard index against the manifest"""
+
+    problems = []
+    if latest_tweet_id is not None and sharded_archive.latest_tweet_id != latest_tweet_id:
+        problems.append(_problem(conversation_id, 'archive', 'trailer_mismatch',
+                                 sharded_archive.directory, latest_tweet_id))
+    indexed_records = sum(shard['records'] for shard in sharded_archive.shards)
+    if message_count is not None and indexed_records < message_count:
+        problems.append(_problem(conversation_id, 'archive', 'missing_messages',
+                                 sharded_archive.directory, latest_tweet_id))
+    return problems
+
+
+def _check_shard(conversation_id, filename, record_count):
+    """Check the record count of a shard against the shard index"""
+
+    if not os.path.isfile(filename):
+        return [_problem(conversation_id, 'archive', 'missing', filename)]
+
+    with ArchiveReader(filename) as reader:
+        counted_records = sum(1 for record in reader)
+    if counted_records < record_count:
+        return [_problem(conversation_id, 'archive', 'missing_messages', filename)]
+    return []
+
+
+def _check_media(conversation_id, path, entry):
+    """Check the size and the hash of a downloaded media"""
+
+    filename = os.path.join(conversation_id, path)
+    problem = None
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        problem = 'missing'
+    else:
+        if size < entry['size'] or entry['sha256'] is None:
+            problem = 'truncated'
+        elif size > entry['size']:
+            problem = 'corrupted'
+        else:
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            if digest.hexdigest() != entry['sha256']:
+                problem = 'corrupted'
+
+    if problem is None:
+        return []
+    return [_problem(conversation_id, 'media', problem, filename,
+                     entry['tweet_id'], entry['url'])]
+
+
+def _run_check(task):
+    function, args = task
+    return function(*args)
+
+
+def verify(conversation_ids, workers=None):
+    """Verify the conversations and return the list of the problems found.
+
+    Each problem is a dictionary with the 'conversation_id', the 'kind'
+    ('archive' or 'media'), the 'problem', the 'path' and, when known,
+    the 'tweet_id' and 'url' to fetch again.
+    """
+
+    problems = []
+    tasks = []
+    for conversation_id in conversation_ids:
+        manifest = Manifest.load(conversation_id)
+        if not manifest.exists():
+            problems.append(_problem(conversation_id, 'archive', 'no_manifest',
+                                     manifest.filename))
+        message_count = manifest.message_count if manifest.exists() else None
+        sharded_archive = ShardedArchive(conversation_id)
+        if sharded_archive.exists():
+            # The shards are checked independently
+            problems += _check_shard_index(conversation_id, sharded_archive,
+                                           manifest.latest_tweet_id, message_count)
+            for shard, filename in zip(sharded_archive.shards, sharded_archive.paths()):
+                tasks.append((_check_shard, (conversation_id, filename, shard['records'])))
+        else:
+            tasks.append((_check_archive, (conversation_id,
+                                           manifest.latest_tweet_id,
+                                           message_count)))
+        for path, entry in sorted(manifest.media.items()):
+            tasks.append((_check_media, (conversation_id, path, entry)))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(_run_check, tasks, chunksize=16):
+            problems += result
+
+    return problems
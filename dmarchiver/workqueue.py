@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Direct Messages Archiver - Work queue
+
+    Shares the crawling of many accounts between several processes or
+    machines. A coordinator fills a SQLite database with one job per
+    (account, conversation) and workers lease the jobs, keep their lease
+    alive with heartbeats while crawling and release them when done.
+    The job of a worker which stopped sending heartbeats is leased again
+    by another worker once its lease has expired.
+
+    Each account is crawled by a single worker at a time, with its own
+    delay between requests and between two jobs.
+
+    Usage:
+
+    >>> from dmarchiver.workqueue import WorkQueue, Worker
+    >>> queue = WorkQueue('queue.db')
+    >>> queue.add_account('username', delay=1)
+    >>> queue.add_job('username', 'conversation_id')
+    >>> Worker(queue, {'username': 'password'}).run()
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+__all__ = ['WorkQueue', 'Worker', 'read_credentials']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    delay REAL NOT NULL DEFAULT 0,
+    next_job REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL REFERENCES accounts(account),
+    conversation_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    UNIQUE (account, conversation_id)
+);
+'''
+
+
+def read_credentials(filename):
+    """Read a file with one 'username:password' per line"""
+
+    credentials = {}
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.rstrip('\r\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            username, separator, password = line.partition(':')
+            if separator == '':
+                raise ValueError(
+                    'Invalid line in {0}, expected \'username:password\''.format(filename))
+            credentials[username.strip()] = password
+    return credentials
+
+
+class Job(object):
+    """This class is a representation of a leased job"""
+
+    def __init__(self, job_id, account, conversation_id, attempts):
+        self.job_id = job_id
+        self.account = account
+        self.conversation_id = conversation_id
+        self.attempts = attempts
+
+
+class WorkQueue(object):
+    """This class is a SQLite-backed queue of (account, conversation) jobs"""
+
+    def __init__(self, filename, lease_duration=300, max_attempts=5):
+        # The worker changes of current directory, and the heartbeat
+        # thread opens the queue again from this path
+        self.filename = os.path.abspath(filename)
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        # Transactions are handled explicitly to lock the database on claim
+        self._connection = sqlite3.connect(
+            self.filename, timeout=60, isolation_level=None)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def add_account(self, account, delay=0):
+        self._connection.execute(
+            'INSERT INTO accounts (account, delay) VALUES (?, ?) '
+            'ON CONFLICT (account) DO UPDATE SET delay = excluded.delay',
+            (account, delay))
+
+    def add_job(self, account, conversation_id):
+        """Queue a conversation, or queue it again if it was already crawled"""
+
+        self._connection.execute(
+            'INSERT INTO jobs (account, conversation_id) VALUES (?, ?) '
+            'ON CONFLICT (account, conversation_id) DO UPDATE '
+            'SET status = \'pending\', attempts = 0, last_error = NULL '
+            'WHERE status IN (\'done\', \'failed\')',
+            (account, conversation_id))
+
+    def get_delay(self, account):
+        row = self._connection.execute(
+            'SELECT delay FROM accounts WHERE account = ?', (account,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def claim(self, worker, accounts=None):
+        """Lease the next available job, or return None.
+
+        A job is available if it is pending or if its lease has expired,
+        and if no other job of the same account is leased. A job whose
+        lease expired on its last attempt (e.g. its worker was killed)
+        is marked as failed instead of being leased again.
+        """
+
+        now = time.time()
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._connection.execute(
+                'UPDATE jobs SET status = \'failed\', worker = NULL, lease_expires = NULL, '
+                'last_error = \'Lease expired\' '
+                'WHERE status = \'leased\' AND lease_expires < ? AND attempts >= ?',
+                (now, self.max_attempts))
+            query = ('SELECT jobs.id, jobs.account, jobs.conversation_id, jobs.attempts '
+                     'FROM jobs JOIN accounts ON accounts.account = jobs.account '
+                     'WHERE (jobs.status = \'pending\' OR (jobs.status = \'leased\' AND jobs.lease_expires < ?)) '
+                     'AND accounts.next_job <= ? '
+                     'AND NOT EXISTS (SELECT 1 FROM jobs AS other WHERE other.account = jobs.account '
+                     'AND other.id != jobs.id AND other.status = \'leased\' AND other.lease_expires >= ?) ')
+            parameters = [now, now, now]
+            if accounts is not None:
+                query += 'AND jobs.account IN ({0}) '.format(
+                    ', '.join('?' * len(accounts)))
+                parameters += list(accounts)
+            query += 'ORDER BY jobs.attempts, jobs.id LIMIT 1'
+
+            row = self._connection.execute(query, parameters).fetchone()
+            if row is None:
+                self._connection.execute('COMMIT')
+                return None
+
+            self._connection.execute(
+                'UPDATE jobs SET status = \'leased\', worker = ?, lease_expires = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (worker, now + self.lease_duration, row[0]))
+            self._connection.execute('COMMIT')
+        except:
+            self._connection.execute('ROLLBACK')
+            raise
+
+        return Job(row[0], row[1], row[2], row[3] + 1)
+
+    def heartbeat(self, job, worker):
+        """Extend the lease of a job. Return False if the lease was lost.
+
+        An expired lease is not extended, the job may already have been
+        leased by another worker.
+        """
+
+        now = time.time()
+        cursor = self._connection.execute(
+            'UPDATE jobs SET lease_expires = ? '
+            'WHERE id = ? AND worker = ? AND status = \'leased\' AND lease_expires >= ?',
+            (now + self.lease_duration, job.job_id, worker, now))
+        return cursor.rowcount == 1
+
+    def _finish(self, job, worker, status, error):
+        """Update a job leased by the worker. Return False if the lease was lost."""
+
+        account_delay = self.get_delay(job.account)
+        self._connection.execute('BEGIN IMMEDIATE')
+        cursor = self._connection.execute(
+            'UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, last_error = ? '
+            'WHERE id = ? AND worker = ? AND status = \'leased\'',
+            (status, error, job.job_id, worker))
+        finished = cursor.rowcount == 1
+        if finished:
+            self._connection.execute(
+                'UPDATE accounts SET next_job = ? WHERE account = ?',
+                (time.time() + account_delay, job.account))
+        self._connection.execute('COMMIT')
+        return finished
+
+    def complete(self, job, worker):
+        return self._finish(job, worker, 'done', None)
+
+    def fail(self, job, worker, error):
+        """Release a failed job, which is retried until max_attempts"""
+
+        status = 'pending'
+        if job.attempts >= self.max_attempts:
+            status = 'failed'
+        return self._finish(job, worker, status, error)
+
+    def release(self, job, worker):
+        """Give back a job without counting the attempt"""
+
+        self._connection.execute(
+            'UPDATE jobs SET status = \'pending\', worker = NULL, lease_expires = NULL, '
+            'attempts = attempts - 1 WHERE id = ? AND worker = ?',
+            (job.job_id, worker))
+
+    def has_unfinished_jobs(self, accounts=None):
+        query = 'SELECT COUNT(*) FROM jobs WHERE status IN (\'pending\', \'leased\')'
+        parameters = []
+        if accounts is not None:
+            query += ' AND account IN ({0})'.format(', '.join('?' * len(accounts)))
+            parameters = list(accounts)
+        return self._connection.execute(query, parameters).fetchone()[0] > 0
+
+    def status(self):
+        """Return the number of jobs per account and status"""
+
+        return self._connection.execute(
+            'SELECT account, status, COUNT(*) FROM jobs '
+            'GROUP BY account, status ORDER BY account, status').fetchall()
+
+
+class _Heartbeat(threading.Thread):
+    """Keep the lease of a job alive while it is being crawled.
+
+    'lease_lost' is set when the lease could not be extended before its
+    expiry, the crawl must then be stopped.
+    """
+
+    def __init__(self, filename, lease_duration, job, worker, interval):
+        super().__init__(daemon=True)
+        self._filename = filename
+        self._lease_duration = lease_duration
+        self._job = job
+        self._worker = worker
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.lease_lost = threading.Event()
+
+    def run(self):
+        # The lease was taken when the thread was started
+        lease_expires = time.time() + self._lease_duration
+        queue = None
+        try:
+            while not self._stopped.wait(self._interval):
+                try:
+                    # SQLite connections cannot be shared between threads
+                    if queue is None:
+                        queue = WorkQueue(self._filename, self._lease_duration)
+                    if not queue.heartbeat(self._job, self._worker):
+                        print('Warning: the lease of the job {0} was lost.'.format(
+                            self._job.job_id))
+                        self.lease_lost.set()
+                        return
+                    lease_expires = time.time() + self._lease_duration
+                except sqlite3.Error as ex:
+                    # E.g. a database locked or a network drive unavailable,
+                    # retried until the lease expires
+                    print('Warning: heartbeat of the job {0} failed: {1}'.format(
+                        self._job.job_id, ex))
+                    if time.time() >= lease_expires:
+                        print('Warning: the lease of the job {0} has expired.'.format(
+                            self._job.job_id))
+                        self.lease_lost.set()
+                        return
+        finally:
+            if queue is not None:
+                queue.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class Worker(object):
+    """This class leases jobs from a queue and crawls them.
+
+    The files of each account are written to '<output_dir>/<account>'.
+    """
+
+    def __init__(
+            self,
+            queue,
+            credentials,
+            worker_id=None,
+            output_dir='.',
+            save_session=False,
+            parse_cache=None,
+            poll_interval=10,
+            crawl_options=None):
+        self._queue = queue
+        self._credentials = credentials
+        if worker_id is None:
+            worker_id = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.worker_id = worker_id
+        self._output_dir = os.path.abspath(output_dir)
+        self._save_session = save_session
+        self._parse_cache = parse_cache
+        self._poll_interval = poll_interval
+        self._crawl_options = crawl_options or {}
+        self._crawlers = {}
+
+    def _get_crawler(self, account):
+        """Return an authenticated crawler for the account"""
+
+        if account not in self._crawlers:
+            from .core import Crawler
+            crawler = Crawler(self._parse_cache)
+            crawler.authenticate(
+                account, self._credentials[account], self._save_session, False)
+            self._crawlers[account] = crawler
+        return self._crawlers[account]
+
+    def run(self):
+        """Process jobs until the queue is empty"""
+
+        accounts = sorted(self._credentials)
+        while True:
+            job = self._queue.claim(self.worker_id, accounts)
+            if job is None:
+                if not self._queue.has_unfinished_jobs(accounts):
+                    print('No more jobs in the queue.')
+                    return
+                time.sleep(self._poll_interval)
+                continue
+
+            print('{0}Job {1}: conversation \'{2}\' of \'{3}\' (attempt {4})'.format(
+                os.linesep, job.job_id, job.conversation_id, job.account, job.attempts))
+
+            heartbeat = _Heartbeat(
+                self._queue.filename, self._queue.lease_duration, job, self.worker_id,
+                max(1, self._queue.lease_duration / 3))
+            heartbeat.start()
+            try:
+                account_dir = os.path.join(self._output_dir, job.account)
+                os.makedirs(account_dir, exist_ok=True)
+                # The crawler writes its files in the current directory
+                os.chdir(account_dir)
+                crawler = self._get_crawler(job.account)
+                # The crawl stops as soon as the lease is lost, the job
+                # may be crawled by another worker
+                crawler.crawl(
+                    job.conversation_id,
+                    self._queue.get_delay(job.account),
+                    stop_event=heartbeat.lease_lost,
+                    **self._crawl_options)
+            except KeyboardInterrupt:
+                heartbeat.stop()
+                self._queue.release(job, self.worker_id)
+                raise
+            except Exception as ex:
+                heartbeat.stop()
+                print('Job {0} failed: {1}'.format(job.job_id, ex))
+                # The session may be the cause of the failure
+                self._crawlers.pop(job.account, None)
+                if not self._queue.fail(job, self.worker_id, str(ex)):
+                    print('The lease of the job {0} was lost, its failure is ignored.'.format(job.job_id))
+            else:
+                heartbeat.stop()
+                if heartbeat.lease_lost.is_set() or not self._queue.complete(job, self.worker_id):
+                    print('The lease of the job {0} was lost, it is left to the worker which took it.'.format(
+                        job.job_id))
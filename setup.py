@@ -1,16 +1,25 @@
 ﻿import codecs
+import re
 from setuptools import setup, find_packages
-import dmarchiver
+
+# Read the version without importing the package and its dependencies
+version = re.search(r'^__version__ = "([^"]+)"',
+                    codecs.open('dmarchiver/__init__.py', 'r', 'utf-8-sig').read(),
+                    re.MULTILINE).group(1)
 
 setup(
 
     name='dmarchiver',
-    version=dmarchiver.__version__,
+    version=version,
 
     packages=find_packages(),
 
     install_requires=['requests==2.11.1', 'lxml==3.6.4', 'cssselect==0.9.2'],
 
+    extras_require={
+        'stats': ['numpy'],
+    },
+
     author="Julien EHRHART",
     author_email="julien.ehrhart@live.com",
 